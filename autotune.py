@@ -0,0 +1,77 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Log based table corrections.  Each sample's error (e.g. lambda error in
+# percent) is spread over the four cells around its operating point with
+# the same bilinear weights the lookup uses, so a cell collects the error
+# of the samples that actually depended on it.  A cell whose weighted hit
+# count reaches min_hits is corrected by its weighted mean error:
+#
+#   new = old * (1 + error / 100)
+
+import lookup
+
+import numpy
+
+class Corrections:
+    def __init__(self, conf, tune, table_name='fuel_table'):
+        self.table = conf.all_tables[table_name]
+        self.lookup = lookup.TableLookup(conf, tune, table_name)
+        self.shape = self.lookup.data.shape
+        self.hits = numpy.zeros(self.shape)
+        self.error = numpy.zeros(self.shape) # weighted sum of errors
+
+    # values maps variable short_name to samples, e.g. a datalog chunk, and
+    # error holds the error of each sample; samples with a non-finite error
+    # are ignored.  Can be called repeatedly to accumulate a long log.
+    def Add(self, values, error):
+        x, y, error = numpy.broadcast_arrays(
+            numpy.asarray(values.get(self.lookup.xvar, 0), dtype=float),
+            numpy.asarray(values.get(self.lookup.yvar, 0), dtype=float),
+            numpy.asarray(error, dtype=float))
+        ok = numpy.isfinite(error)
+        x, y, error = x[ok], y[ok], error[ok]
+        h, w = self.shape
+        ix, fx = lookup.Locate(self.lookup.xbins, x)
+        iy, fy = lookup.Locate(self.lookup.ybins, y)
+        dx = 1 if w > 1 else 0
+        dy = w if h > 1 else 0
+        base = iy * w + ix
+        cells = numpy.concatenate([base, base + dx, base + dy, base + dy + dx])
+        weights = numpy.concatenate([(1 - fx) * (1 - fy), fx * (1 - fy),
+                                     (1 - fx) * fy, fx * fy])
+        self.hits += numpy.bincount(cells, weights, h * w).reshape(self.shape)
+        self.error += numpy.bincount(cells, weights * numpy.tile(error, 4),
+                                     h * w).reshape(self.shape)
+
+    # Weighted mean error per cell, NaN where there were no hits
+    def MeanError(self):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self.error / self.hits
+
+    # Suggested table contents, cells below min_hits keep their value
+    def Suggested(self, min_hits=10):
+        old = self.lookup.data
+        new = numpy.where(self.hits >= min_hits,
+                          old * (1 + numpy.nan_to_num(self.MeanError()) / 100), old)
+        return numpy.clip(new, *self.table.CellRange())
+
+    # Writes the suggested values into the tune, returns the number of
+    # cells corrected
+    def Apply(self, tune, min_hits=10):
+        self.table.setDataBlock(tune, self.Suggested(min_hits).tolist())
+        return int(numpy.count_nonzero(self.hits >= min_hits))
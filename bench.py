@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Benchmarks of the tune codec on synthetic configurations, without the GUI
+# (and without Qt):
+#
+#   ./bench.py [--quick] [--repeat N] [--out FILE] [--baseline FILE]
+#
+# Covers Config.Encode/Decode with hundreds of tables, the cell accessors
+# for every table encoding up to the 255x255 limit, the table allocator on
+# a fragmented table region, and conditionals.  The configurations and
+# tunes are generated from a fixed seed, so runs are comparable.  Results
+# are the best of --repeat runs in seconds per operation, written as JSON;
+# with --baseline, anything more than --threshold slower than a previous
+# run is reported and the exit status is 1.
+
+import config
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+encodings = (1.5, -1.5, 1, 2)
+
+variables = [
+    ['None', None, False, '', 0, 0, 0],
+    ['Engine Speed', 'rpm', True, 'RPM', 0, 16, 0],
+    ['Manifold Pressure', 'map', True, 'kPa', 2, 16, -1],
+    ['Coolant Temp', 'ect', True, 'C', 4, 16, -1],
+]
+
+# Configuration with ntables tables of the given encoding, each with an
+# enable switch its conditional reads, plus a mode all conditionals read
+def Synthetic(ntables, encoding, total_size):
+    mode = ['select', 'Mode', 'mode', 0, ['OFF', 'ON', 'AUTO']]
+    fields = [mode]
+    for i in range(ntables):
+        fields.append(['select', 'Table %d Enabled?' % i, 'tbl%d_en' % i,
+                       1 + 2 * ntables + i, ['False', 'True']])
+        fields.append(['table', 'Table %d' % i, 'tbl%d' % i, '%', 1 + 2 * i, encoding, -1,
+                       "tbl%d_en == 'True' and mode != 'OFF'" % i])
+    return config.Config({
+        'table_offset': 1 + 3 * ntables,
+        'total_size': total_size,
+        'variables': variables,
+        'fields': [['page', 'Tables'] + fields],
+    })
+
+# Allocates a table with nx by ny bins and fills it with random data
+def AddTable(conf, tune, name, nx, ny, rand):
+    ptr = conf.AllocateTable(tune, name, 1, 'rpm', [500 * i for i in range(nx)],
+                             -1, 'map', [10 * i for i in range(ny)])
+    if ptr is None:
+        return None
+    tbl = conf.all_tables[name]
+    tbl.setTablePtr(tune, ptr)
+    lo, hi = tbl.CellRange()
+    tbl.setDataBlock(tune, [[rand.uniform(lo, hi) for c in range(max(nx, 1))]
+                            for r in range(max(ny, 1))])
+    conf.all_fields[name + '_en'].set(tune, conf, 'True')
+    return ptr
+
+# Tune with as many tables of random shape as fit
+def Populate(conf, rand, sizes=(4, 24)):
+    tune = config.Tune(conf.total_size)
+    conf.all_fields['mode'].set(tune, conf, 'ON')
+    for name in conf.all_tables:
+        if AddTable(conf, tune, name, rand.randint(*sizes), rand.randint(*sizes), rand) is None:
+            break
+    return tune
+
+# Tune whose table region is exactly filled by ntables tables
+def Packed(ntables, seed, sizes):
+    conf = Synthetic(ntables, 1.5, 65535)
+    tune = Populate(conf, random.Random(seed), sizes)
+    end = max([t.TablePtr(tune) + t.TableLen(tune) for t in conf.all_tables.values()])
+    conf = Synthetic(ntables, 1.5, end)
+    return conf, Populate(conf, random.Random(seed), sizes)
+
+# Best time over repeat runs of func(), or of func(setup()) with the setup
+# untimed
+def Time(func, repeat, setup=None):
+    best = None
+    for i in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        func(arg) if setup else func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def Codec(results, repeat, quick):
+    shapes = [(16, 16), (64, 64)] if quick else [(16, 16), (64, 64), (255, 255)]
+    for enc in encodings:
+        for w, h in shapes:
+            rand = random.Random(1)
+            # Ptrs are 16 bits, the data of a big table may run past that
+            conf = Synthetic(1, enc, 1024 + 4 * w * h)
+            tune = config.Tune(conf.total_size)
+            AddTable(conf, tune, 'tbl0', w, h, rand)
+            tbl = conf.all_tables['tbl0']
+            cells = [(r, c) for r in range(h) for c in range(w)]
+            vals = [rand.uniform(*tbl.CellRange()) for rc in cells]
+            block = tbl.DataBlock(tune)
+            key = '%s/%dx%d' % (enc, w, h)
+            n = len(cells)
+
+            def get():
+                for r, c in cells:
+                    tbl.Data(tune, r, c)
+
+            def put():
+                for (r, c), v in zip(cells, vals):
+                    tbl.setData(tune, r, c, v)
+
+            results['Data ' + key] = Time(get, repeat) / n
+            results['setData ' + key] = Time(put, repeat) / n
+            results['DataBlock ' + key] = Time(lambda: tbl.DataBlock(tune), repeat) / n
+            results['setDataBlock ' + key] = Time(lambda: tbl.setDataBlock(tune, block),
+                                                  repeat) / n
+
+def EncodeDecode(results, repeat, quick):
+    for ntables in [100] if quick else [100, 300]:
+        conf = Synthetic(ntables, 1.5, 65535)
+        tune = Populate(conf, random.Random(2), (2, 12))
+        data = conf.Decode(tune)['tune']
+        key = '%d tables' % ntables
+        results['Decode ' + key] = Time(lambda: conf.Decode(tune), repeat)
+        results['Encode ' + key] = Time(lambda: conf.Encode(data), repeat)
+    if not quick:
+        conf = Synthetic(1, 2, 1024 + 4 * 255 * 255)
+        tune = config.Tune(conf.total_size)
+        AddTable(conf, tune, 'tbl0', 255, 255, random.Random(3))
+        data = conf.Decode(tune)['tune']
+        results['Decode 255x255'] = Time(lambda: conf.Decode(tune), repeat)
+        results['Encode 255x255'] = Time(lambda: conf.Encode(data), repeat)
+
+# The table region is filled, then every other table freed, leaving many
+# small holes: new tables either squeeze into one or force a compaction
+def Allocator(results, repeat, quick):
+    ntables = 100 if quick else 300
+    rand = random.Random(4)
+    conf, full = Packed(ntables, 4, (2, 12))
+    names = [n for n in conf.all_tables if conf.all_tables[n].TablePtr(full)]
+    for n in names[::2]:
+        conf.FreeTable(full, n)
+    freed = names[::2]
+    stats = conf.TableSpaceStats(full)
+
+    def fragmented():
+        tune = config.Tune(full)
+        conf.InvalidateCaches()
+        return tune
+
+    def refill(tune):
+        for n in freed:
+            AddTable(conf, tune, n, 4, 4, rand)
+
+    # Bigger than any hole but not than all of them together
+    nx, ny = 40, 30
+    size = len(conf.BuildTable(freed[0], 0, 'rpm', range(nx), 0, 'map', range(ny)))
+
+    def big(tune):
+        AddTable(conf, tune, freed[0], nx, ny, rand)
+
+    def rebuild(tune):
+        conf.GetFreeTableSpace(tune)
+
+    key = '%d tables' % ntables
+    results['GetFreeTableSpace rebuild ' + key] = Time(rebuild, repeat, fragmented)
+    tune = fragmented()
+    conf.GetFreeTableSpace(tune)
+    results['GetFreeTableSpace cached ' + key] = Time(lambda: conf.GetFreeTableSpace(tune),
+                                                      repeat)
+    results['AllocateTable fit ' + key] = Time(refill, repeat, fragmented) / len(freed)
+    if stats['largest'] < size <= stats['free']:
+        results['AllocateTable compact ' + key] = Time(big, repeat, fragmented)
+
+def Conditionals(results, repeat, quick):
+    conf = Synthetic(100, 1.5, 65535)
+    tune = Populate(conf, random.Random(5))
+    conds = [t.conditional for t in conf.all_tables.values()]
+
+    def run():
+        for c in conds:
+            conf.EvalConditional(tune, c)
+
+    results['EvalConditional'] = Time(run, repeat) / len(conds)
+
+benchmarks = [Codec, EncodeDecode, Allocator, Conditionals]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tune codec')
+    parser.add_argument('--quick', action='store_true', help='smaller configurations')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark')
+    parser.add_argument('--out', default='bench.json', help='JSON file for the results')
+    parser.add_argument('--baseline', help='JSON file of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fraction slower than the baseline counted as a regression')
+    args = parser.parse_args()
+
+    results = {}
+    for bench in benchmarks:
+        bench(results, args.repeat, args.quick)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    slower = []
+    for name, secs in results.items():
+        line = '%-40s %12.3f us' % (name, secs * 1e6)
+        if baseline.get(name):
+            ratio = secs / baseline[name]
+            line += '  %5.2fx' % ratio
+            if ratio > 1 + args.threshold:
+                line += '  SLOWER'
+                slower.append(name)
+        print(line)
+
+    with open(args.out, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'quick': args.quick,
+                   'repeat': args.repeat,
+                   'results': results}, f, indent=2)
+    sys.exit(1 if slower else 0)
+
+if __name__ == '__main__':
+    main()
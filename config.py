@@ -17,8 +17,32 @@
 
 
 
+import ast
+import bisect
 import struct
 
+byte_struct = struct.Struct('B')
+ptr_struct = struct.Struct('H')
+axis_struct = struct.Struct('BbH')
+struct_cache = {} # map format to struct.Struct
+
+def Struct(fmt):
+    if fmt not in struct_cache:
+        struct_cache[fmt] = struct.Struct(fmt)
+    return struct_cache[fmt]
+
+# The tune image.  Everything in this module that writes to a tune reports
+# the bytes it changed to the tune's watchers, so edits can be tracked
+# without diffing the whole image.  Writes through memoryviews bypass this.
+class Tune(bytearray):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.watchers = [] # called with (offset, size) after each write
+
+def Written(tune, offset, size):
+    for w in getattr(tune, 'watchers', ()):
+        w(offset, size)
+
 class Variable:
     def __init__(self, name, short_name, can_set, units, offset, encoding, exponent):
         self.name = name
@@ -42,15 +66,22 @@ class Scalar:
         self.format = {
             2: 'H',
         }[encoding]
+        self.struct = Struct(self.format)
+        self.size = self.struct.size
 
     def get(self, tune):
-        return struct.unpack_from(self.format, tune, self.offset)[0] * 10 ** self.exponent
+        return self.struct.unpack_from(tune, self.offset)[0] * 10 ** self.exponent
 
     def set(self, tune, conf, val):
         val *= 10 ** -self.exponent
         if self.format != 'f':
             val = int(val)
-        struct.pack_into(self.format, tune, self.offset, val)
+        self.struct.pack_into(tune, self.offset, val)
+        Written(tune, self.offset, self.struct.size)
+
+    # Raw (unscaled) value, shares memory with the tune
+    def View(self, tune):
+        return memoryview(tune)[self.offset : self.offset + self.struct.size].cast(self.format)
 
     def decode(self, tune, conf):
         return self.get(tune)
@@ -65,12 +96,18 @@ class Select:
         self.offset = offset
         self.choices = choices
         self.conditional = conditional
+        self.size = 1
 
     def get(self, tune):
-        return self.choices[struct.unpack_from('B', tune, self.offset)[0]]
+        return self.choices[byte_struct.unpack_from(tune, self.offset)[0]]
 
     def set(self, tune, conf, val):
-        struct.pack_into('B', tune, self.offset, self.choices.index(val))
+        byte_struct.pack_into(tune, self.offset, self.choices.index(val))
+        Written(tune, self.offset, 1)
+
+    # Raw choice index, shares memory with the tune
+    def View(self, tune):
+        return memoryview(tune)[self.offset : self.offset + 1]
 
     def decode(self, tune, conf):
         return self.get(tune)
@@ -84,12 +121,18 @@ class VarSelect:
         self.short_name = short_name
         self.offset = offset
         self.conditional = conditional
+        self.size = 1
 
     def get(self, tune, conf):
-        return conf.variables[struct.unpack_from('B', tune, self.offset)[0]]
+        return conf.variables[byte_struct.unpack_from(tune, self.offset)[0]]
 
     def set(self, tune, conf, val):
-        struct.pack_into('B', tune, self.offset, conf.variables.index(val))
+        byte_struct.pack_into(tune, self.offset, conf.variable_index[val])
+        Written(tune, self.offset, 1)
+
+    # Raw variable index, shares memory with the tune
+    def View(self, tune):
+        return memoryview(tune)[self.offset : self.offset + 1]
 
     def decode(self, tune, conf):
         return self.get(tune, conf)
@@ -104,13 +147,20 @@ class Text:
         self.offset = offset
         self.length = length
         self.conditional = conditional
+        self.struct = Struct('%ds' % length)
+        self.size = length
 
     def get(self, tune):
-        s = struct.unpack_from('%ds' % self.length, tune, self.offset)[0]
+        s = self.struct.unpack_from(tune, self.offset)[0]
         return s.decode().split('\0')[0]
 
     def set(self, tune, conf, val):
-        struct.pack_into('%ds' % self.length, tune, self.offset, val.encode())
+        self.struct.pack_into(tune, self.offset, val.encode())
+        Written(tune, self.offset, self.length)
+
+    # Raw nul padded bytes, shares memory with the tune
+    def View(self, tune):
+        return memoryview(tune)[self.offset : self.offset + self.length]
 
     def decode(self, tune, conf):
         return self.get(tune)
@@ -118,6 +168,32 @@ class Text:
     def encode(self, tune, conf, val):
         self.set(tune, conf, val)
 
+# Parsed table header, so cell accessors don't have to chase pointers
+class TableLayout:
+    def __init__(self, table, tune):
+        self.ptr = ptr_struct.unpack_from(tune, table.offset)[0]
+        self.bits = int(abs(table.encoding) * 8)
+        self.nbins = [0, 0]
+        self.exponents = [0, 0]
+        self.vars = [0, 0] # variable index for each axis
+        self.axis_ptr = [0, 0]
+        self.bins_struct = [None, None]
+        self.data_ptr = 0
+        self.length = 0
+        if not self.ptr:
+            return
+        ptr = self.ptr + 4
+        for axis in range(2):
+            self.axis_ptr[axis] = ptr
+            (self.nbins[axis], self.exponents[axis],
+             self.vars[axis]) = axis_struct.unpack_from(tune, ptr)
+            self.bins_struct[axis] = Struct('%dh' % self.nbins[axis])
+            ptr += 4 + 2 * self.nbins[axis]
+        self.data_ptr = ptr
+        w, h = self.nbins
+        self.length = (ptr - self.ptr +
+                       (int(abs(table.encoding) * max(w, 1) * max(h, 1) + 1.9) & -2))
+
 class Table:
     def __init__(self, name, short_name, units, offset, encoding, exponent, conditional = None):
         self.name = name
@@ -127,81 +203,83 @@ class Table:
         self.encoding = encoding
         self.exponent = exponent
         self.conditional = conditional
+        self.size = ptr_struct.size # the pointer, the table is in the table region
+        self.layout = None # TableLayout, valid only for layout_tune
+        self.layout_tune = None
+
+    def Layout(self, tune):
+        if self.layout_tune is not tune:
+            self.layout = TableLayout(self, tune)
+            self.layout_tune = tune
+        return self.layout
+
+    # Must be called whenever the table pointer or header is rewritten
+    def InvalidateLayout(self):
+        self.layout = None
+        self.layout_tune = None
 
     def Interpolate(self, tune):
-        if not self.TablePtr(tune):
+        ptr = self.TablePtr(tune)
+        if not ptr:
             return 0
-        return struct.unpack_from('B', tune, self.TablePtr(tune))[0]
+        return tune[ptr]
 
     def SetInterpolate(self, tune, intrp):
         if not self.TablePtr(tune):
             raise
-        struct.pack_into('B', tune, self.TablePtr(tune), intrp)
+        byte_struct.pack_into(tune, self.TablePtr(tune), intrp)
+        Written(tune, self.TablePtr(tune), 1)
 
     def InterpolateVar(self, tune, config, var):
-        if not self.TablePtr(tune):
+        ptr = self.TablePtr(tune)
+        if not ptr:
             return 0
-        return config.variables[struct.unpack_from('B', tune, self.TablePtr(tune) + 1 + var)[0]]
+        return config.variables[tune[ptr + 1 + var]]
 
     def SetInterpolateVar(self, tune, config, var, intrp):
         if not self.TablePtr(tune):
             raise
-        struct.pack_into('B', tune, self.TablePtr(tune) + 1 + var, config.variables.index(intrp))
+        byte_struct.pack_into(tune, self.TablePtr(tune) + 1 + var, config.variable_index[intrp])
+        Written(tune, self.TablePtr(tune) + 1 + var, 1)
 
     def TablePtr(self, tune):
-        return struct.unpack_from("H", tune, self.offset)[0]
+        return self.Layout(tune).ptr
 
     def setTablePtr(self, tune, ptr):
-        struct.pack_into('H', tune, self.offset, ptr)
+        ptr_struct.pack_into(tune, self.offset, ptr)
+        self.InvalidateLayout()
+        Written(tune, self.offset, 2)
 
     def TableLen(self, tune):
-        if not self.TablePtr(tune):
-            return 0
-        w = self.AxisNBins(tune, 0)
-        h = self.AxisNBins(tune, 1)
-        xsize = 4 + 4 + 2 * w
-        ysize = 4 + 2 * h
-        dsize = int(abs(self.encoding) * max(w, 1) * max(h, 1) + 1.9) & -2
-        return xsize + ysize + dsize
+        return self.Layout(tune).length
 
     def AxisNBins(self, tune, axis):
-        if not self.TablePtr(tune):
-            return 0
-        return struct.unpack_from('B', tune, self.AxisPtr(tune, axis))[0]
+        return self.Layout(tune).nbins[axis]
 
     def AxisPtr(self, tune, axis):
-        ptr = self.TablePtr(tune)
-        if axis:
-            ptr += 4 + 2 * self.AxisNBins(tune, 0)
-        return ptr + 4
+        return self.Layout(tune).axis_ptr[axis]
 
     def AxisBins(self, tune, axis):
-        if not self.TablePtr(tune):
+        layout = self.Layout(tune)
+        if not layout.ptr:
             return []
-        ptr = self.AxisPtr(tune, axis)
-        nbins = self.AxisNBins(tune, axis)
-        exp = 10 ** self.AxisExponent(tune, axis)
-        return [exp * b for b in struct.unpack_from('%dh' % nbins, tune, ptr + 4)]
+        exp = 10 ** layout.exponents[axis]
+        return [exp * b for b in layout.bins_struct[axis].unpack_from(tune,
+                                                                      layout.axis_ptr[axis] + 4)]
 
     def AxisExponent(self, tune, axis):
-        if not self.TablePtr(tune):
-            return 0
-        return struct.unpack_from('b', tune, self.AxisPtr(tune, axis) + 1)[0]
+        return self.Layout(tune).exponents[axis]
 
     def AxisShortName(self, config, tune, axis):
-        if self.AxisNBins(tune, axis) == 0: return None
-        return config.variables[struct.unpack_from('H', tune, self.AxisPtr(tune, axis) + 2)[0]]
+        layout = self.Layout(tune)
+        if layout.nbins[axis] == 0: return None
+        return config.variables[layout.vars[axis]]
 
     def DataPtr(self, tune, r, c):
-        w = self.AxisNBins(tune, 0)
-        h = self.AxisNBins(tune, 1)
-        ptr = self.TablePtr(tune) + 12 + 2 * (w + h)
-        w = w or 1
-        rem = int(8 * abs(self.encoding))
-        ptr = ptr * 8 + rem * (r * w + c)
-        bit = ptr % 8
-        ptr >>= 3
-        return (ptr, bit, rem)
+        layout = self.Layout(tune)
+        rem = layout.bits
+        ptr = layout.data_ptr * 8 + rem * (r * (layout.nbins[0] or 1) + c)
+        return (ptr >> 3, ptr & 7, rem)
 
     def Data(self, tune, r, c):
         if not self.TablePtr(tune):
@@ -225,14 +303,173 @@ class Table:
         if not self.TablePtr(tune):
             return
         span = 1 << int(abs(self.encoding) * 8)
-        val = int(round(val * 10 ** -self.exponent)) & (span - 1)
+        val = self.Saturate(int(round(val * 10 ** -self.exponent))) & (span - 1)
         ptr, bit, rem = self.DataPtr(tune, r, c)
+        start = ptr
         while rem > 0:
-            tune[ptr] = (tune[ptr] & ((1 << bit) - 1)) | (val << bit)
-            val >>= 8 - bit
-            rem -= 8 - bit
+            n = min(8 - bit, rem)
+            mask = ((1 << n) - 1) << bit
+            tune[ptr] = (tune[ptr] & ~mask) | ((val << bit) & mask)
+            val >>= n
+            rem -= n
             bit = 0
             ptr += 1
+        Written(tune, start, ptr - start)
+
+    def DataShape(self, tune):
+        w, h = self.Layout(tune).nbins
+        return (h or 1, w or 1)
+
+    # Smallest and largest raw cell values the encoding can hold
+    def RawRange(self):
+        bits = int(abs(self.encoding) * 8)
+        if self.encoding < 0:
+            return (-(1 << (bits - 1)), (1 << (bits - 1)) - 1)
+        return (0, (1 << bits) - 1)
+
+    def CellRange(self):
+        exp = 10 ** self.exponent
+        return tuple([v * exp for v in self.RawRange()])
+
+    def Saturate(self, raw):
+        lo, hi = self.RawRange()
+        return min(max(raw, lo), hi)
+
+    # Raw cell codec for a whole packed data block, cells in row major order
+    def UnpackCells(self, tune, ptr, n):
+        bits = int(abs(self.encoding) * 8)
+        signed = self.encoding < 0
+        if bits in (8, 16):
+            fmt = {8: 'b', 16: 'h'}[bits]
+            return list(Struct('<%d%s' % (n, fmt if signed else fmt.upper()))
+                        .unpack_from(tune, ptr))
+        span = 1 << bits
+        nbytes = (bits * n + 7) >> 3
+        if bits == 12:
+            b = bytes(tune[ptr : ptr + nbytes]).ljust(3 * ((n + 1) >> 1), b'\0')
+            vals = [0] * (n + (n & 1))
+            vals[0::2] = [lo | (mid & 15) << 8 for lo, mid in zip(b[0::3], b[1::3])]
+            vals[1::2] = [mid >> 4 | hi << 4 for mid, hi in zip(b[1::3], b[2::3])]
+            del vals[n:]
+        else:
+            v = int.from_bytes(tune[ptr : ptr + nbytes], 'little')
+            vals = [(v >> (bits * i)) & (span - 1) for i in range(n)]
+        if signed:
+            half = span >> 1
+            vals = [v - span if v & half else v for v in vals]
+        return vals
+
+    def PackCells(self, vals):
+        bits = int(abs(self.encoding) * 8)
+        span = 1 << bits
+        vals = [v & (span - 1) for v in vals]
+        n = len(vals)
+        if bits in (8, 16):
+            return Struct('<%d%s' % (n, {8: 'B', 16: 'H'}[bits])).pack(*vals)
+        nbytes = (bits * n + 7) >> 3
+        if bits == 12:
+            if n & 1:
+                vals.append(0)
+            b = bytearray(3 * (len(vals) >> 1))
+            b[0::3] = bytes([a & 0xff for a in vals[0::2]])
+            b[1::3] = bytes([a >> 8 | (c & 15) << 4 for a, c in zip(vals[0::2], vals[1::2])])
+            b[2::3] = bytes([c >> 4 for c in vals[1::2]])
+            return bytes(b[:nbytes])
+        v = 0
+        for i, c in enumerate(vals):
+            v |= c << (bits * i)
+        return v.to_bytes(nbytes, 'little')
+
+    # Reads the entire data block in one pass, returns a list of rows
+    def DataBlock(self, tune):
+        if not self.TablePtr(tune):
+            return []
+        h, w = self.DataShape(tune)
+        exp = 10 ** self.exponent
+        vals = self.UnpackCells(tune, self.Layout(tune).data_ptr, w * h)
+        return [[v * exp for v in vals[r * w : (r + 1) * w]] for r in range(h)]
+
+    # Writes the entire data block in one pass from a 2-D sequence of rows
+    def setDataBlock(self, tune, data):
+        if not self.TablePtr(tune):
+            return
+        h, w = self.DataShape(tune)
+        exp = 10 ** -self.exponent
+        lo, hi = self.RawRange()
+        packed = self.PackCells([min(max(int(round(data[r][c] * exp)), lo), hi)
+                                 for r in range(h) for c in range(w)])
+        ptr = self.Layout(tune).data_ptr
+        tune[ptr : ptr + len(packed)] = packed
+        Written(tune, ptr, len(packed))
+
+    # Block operations on a selection of cells, rows top..bottom and columns
+    # left..right inclusive.  Each reads the data block once, computes the
+    # new values from the old ones and writes the block back in one store,
+    # saturating to the encoding.
+    def ApplyCells(self, tune, sel, func):
+        if not self.TablePtr(tune):
+            return
+        top, left, bottom, right = sel
+        old = self.DataBlock(tune)
+        new = [list(row) for row in old]
+        for r in range(top, bottom + 1):
+            for c in range(left, right + 1):
+                new[r][c] = func(old, r, c)
+        self.setDataBlock(tune, new)
+
+    def ScaleCells(self, tune, sel, percent):
+        self.ApplyCells(tune, sel, lambda d, r, c: d[r][c] * (1 + percent / 100))
+
+    def OffsetCells(self, tune, sel, delta):
+        self.ApplyCells(tune, sel, lambda d, r, c: d[r][c] + delta)
+
+    def SetCells(self, tune, sel, val):
+        self.ApplyCells(tune, sel, lambda d, r, c: val)
+
+    # Linear fill from the corners of the selection, weighted by the axis
+    # bins so unevenly spaced bins get straight lines
+    def InterpolateCells(self, tune, sel):
+        top, left, bottom, right = sel
+        xbins = self.AxisBins(tune, 0) or [0]
+        ybins = self.AxisBins(tune, 1) or [0]
+        def frac(bins, i, a, b):
+            if bins[b] != bins[a]:
+                return (bins[i] - bins[a]) / (bins[b] - bins[a])
+            return (i - a) / (b - a) if b != a else 0
+        def interp(d, r, c):
+            fx = frac(xbins, c, left, right)
+            fy = frac(ybins, r, top, bottom)
+            upper = d[top][left] + (d[top][right] - d[top][left]) * fx
+            lower = d[bottom][left] + (d[bottom][right] - d[bottom][left]) * fx
+            return upper + (lower - upper) * fy
+        self.ApplyCells(tune, sel, interp)
+
+    # Average of each cell and its neighbours within the table
+    def SmoothCells(self, tune, sel):
+        h, w = self.DataShape(tune)
+        def smooth(d, r, c):
+            vals = [d[i][j] for i in range(max(r - 1, 0), min(r + 2, h))
+                    for j in range(max(c - 1, 0), min(c + 2, w))]
+            return sum(vals) / len(vals)
+        self.ApplyCells(tune, sel, smooth)
+
+    # Raw axis bins, shares memory with the tune until the table is moved
+    def AxisView(self, tune, axis):
+        layout = self.Layout(tune)
+        ptr = layout.axis_ptr[axis] + 4
+        return memoryview(tune)[ptr : ptr + 2 * layout.nbins[axis]].cast('h')
+
+    # Raw cells as a rows x columns view for 8 and 16 bit tables; 12 bit
+    # tables can only be viewed as the packed bytes
+    def DataView(self, tune):
+        layout = self.Layout(tune)
+        h, w = self.DataShape(tune)
+        nbytes = (layout.bits * w * h + 7) >> 3
+        view = memoryview(tune)[layout.data_ptr : layout.data_ptr + nbytes]
+        if layout.bits not in (8, 16):
+            return view
+        fmt = {8: 'b', 16: 'h'}[layout.bits]
+        return view.cast(fmt if self.encoding < 0 else fmt.upper(), [h, w])
 
     def decode_axis(self, tune, conf, axis):
         if self.AxisNBins(tune, axis) == 0: return None
@@ -241,10 +478,7 @@ class Table:
                 *self.AxisBins(tune, axis)]
 
     def decode_data(self, tune):
-        w = self.AxisNBins(tune, 0) or 1
-        h = self.AxisNBins(tune, 1) or 2
-        return [[self.Data(tune, r, c) for c in range(w)]
-                for r in range(h)]
+        return self.DataBlock(tune)
 
     def decode(self, tune, conf):
         if not self.TablePtr(tune):
@@ -261,23 +495,135 @@ class Table:
     def encode(self, tune, conf, val):
         if val is None:
             return
-        tbl = conf.AllocateTable(tune, self.short_name,
+        tbl = conf.ResizeTable(tune, self.short_name,
                                  val['x-axis'][1] if val['x-axis'] else 0,
                                  val['x-axis'][0] if val['x-axis'] else None,
                                  val['x-axis'][2:] if val['x-axis'] else [],
                                  val['y-axis'][1] if val['y-axis'] else 0,
                                  val['y-axis'][0] if val['y-axis'] else None,
                                  val['y-axis'][2:] if val['y-axis'] else [])
-        self.setTablePtr(tune, tbl)
         self.SetInterpolate(tune, val['interpolate'])
         self.SetInterpolateVar(tune, conf, 0, val['interpolate-B'])
         self.SetInterpolateVar(tune, conf, 1, val['interpolate-C'])
-        w = self.AxisNBins(tune, 0) or 1
-        h = self.AxisNBins(tune, 1) or 2
-        for r in range(h):
-            for c in range(w):
-                self.setData(tune, r, c, val['data'][r][c])
-
+        self.setDataBlock(tune, val['data'])
+
+
+# Maps field short_name to its raw memoryview, e.g. to hand to a comms layer
+class TuneView:
+    def __init__(self, conf, tune):
+        self.conf = conf
+        self.buffer = memoryview(tune)
+        self.views = {}
+
+    def __getitem__(self, short_name):
+        if short_name not in self.views:
+            f = self.conf.all_fields[short_name]
+            if isinstance(f, Table):
+                self.views[short_name] = self.buffer[f.offset : f.offset + 2].cast('H')
+            else:
+                self.views[short_name] = f.View(self.buffer)
+        return self.views[short_name]
+
+# Everything that has to be refreshed when a field changes
+class Dependents:
+    def __init__(self):
+        self.conditionals = [] # fields whose conditional reads it
+        self.labels = [] # menu labels substituting it with $short_name
+        self.variables = [] # variables whose name substitutes it
+
+# Sorted, non-overlapping [begin, end) ranges; ranges that touch are merged
+class RangeSet:
+    def __init__(self):
+        self.ranges = []
+
+    def Add(self, begin, size):
+        end = begin + size
+        i = bisect.bisect_left(self.ranges, (begin, end))
+        if i and self.ranges[i - 1][1] >= begin:
+            i -= 1
+            begin = min(begin, self.ranges[i][0])
+        j = i
+        while j < len(self.ranges) and self.ranges[j][0] <= end:
+            end = max(end, self.ranges[j][1])
+            j += 1
+        self.ranges[i:j] = [(begin, end)]
+
+    def Remove(self, begin, size):
+        end = begin + size
+        i = bisect.bisect_right(self.ranges, (begin, begin))
+        if i and self.ranges[i - 1][1] > begin:
+            i -= 1
+        j = i
+        while j < len(self.ranges) and self.ranges[j][0] < end:
+            j += 1
+        repl = []
+        if i < j:
+            if self.ranges[i][0] < begin:
+                repl.append((self.ranges[i][0], begin))
+            if self.ranges[j - 1][1] > end:
+                repl.append((end, self.ranges[j - 1][1]))
+        self.ranges[i:j] = repl
+
+    def Clear(self):
+        self.ranges = []
+
+# The free extents of the table region
+class TableAllocator(RangeSet):
+    def __init__(self, begin, end):
+        self.ranges = [(begin, end)] if end > begin else []
+
+    def Reserve(self, ptr, size):
+        self.Remove(ptr, size)
+
+    def Release(self, ptr, size):
+        self.Add(ptr, size)
+
+    def Allocate(self, size, best_fit=True):
+        best = None
+        for b, e in self.ranges:
+            if e - b >= size and (best is None or e - b < best[1] - best[0]):
+                best = (b, e)
+                if not best_fit or e - b == size:
+                    break
+        if best is None:
+            return None
+        self.Reserve(best[0], size)
+        return best[0]
+
+    def IsFree(self, ptr, size):
+        i = bisect.bisect_right(self.ranges, (ptr, float('inf'))) - 1
+        return i >= 0 and self.ranges[i][1] >= ptr + size
+
+    def Stats(self):
+        sizes = [e - b for b, e in self.ranges]
+        total = sum(sizes)
+        largest = max(sizes, default=0)
+        return {'free': total,
+                'largest': largest,
+                'extents': len(sizes),
+                'fragmentation': 1 - largest / total if total else 0.0}
+
+# List the [begin, end) ranges where two equally sized images differ, merging
+# ranges separated by no more than gap unchanged bytes
+def ChangedRanges(old, new, gap=0, chunk=64):
+    ret = []
+    old = memoryview(old)
+    new = memoryview(new)
+    for base in range(0, len(new), chunk):
+        if old[base : base+chunk] == new[base : base+chunk]:
+            continue
+        for i in range(base, min(base + chunk, len(new))):
+            if old[i] != new[i]:
+                if ret and i - ret[-1][1] <= gap:
+                    ret[-1][1] = i + 1
+                else:
+                    ret.append([i, i + 1])
+    return [tuple(r) for r in ret]
+
+# Labels may end in $short_name to show the value of a text field
+def SubstField(txt):
+    v = txt.split('$')
+    return v[1] if len(v) > 1 else None
 
 class_map = {
     'scalar': Scalar,
@@ -294,16 +640,31 @@ class Config:
         self.table_offset = variables['table_offset']
         self.total_size = variables['total_size']
         self.variables = [v[1] for v in variables['variables']] # index to short_name
+        self.variable_index = {} # map short_name to index
+        for i, v in enumerate(self.variables):
+            self.variable_index.setdefault(v, i)
         self.all_variables = {} # map short_name to Variable
         self.all_tables = {} # map short_name to Table
         self.all_fields = {} # map short_name to Table, Scalar, Select, or Text
+        self.allocator = None # TableAllocator, valid only for allocator_tune
+        self.allocator_tune = None
+        self.table_spans = [] # (ptr, end, short_name) of placed tables, sorted
+        self.table_begins = []
+        self.table_spans_tune = None # tune table_spans is valid for
+        self.conditionals = {} # map expression to (code, referenced names)
+        self.dependents = {} # map short_name to Dependents
+        self.field_begins = [] # sorted field offsets in the fixed area
+        self.field_spans = [] # (begin, end, Field) in the same order
 
         for v in variables['variables']:
             c = Variable(*v)
             self.all_variables[c.short_name] = c
+            if SubstField(c.name):
+                self.AddDependent(SubstField(c.name)).variables.append(c.short_name)
 
         for m in variables['fields']:
             self.ProcessMenu(m)
+        self.IndexFields()
 
     def Decode(self, tune):
         return {'config': self.conf,
@@ -311,12 +672,55 @@ class Config:
                               for f in self.all_fields.values()])}
 
     def Encode(self, data):
-        tune = bytearray(self.total_size)
+        tune = Tune(self.total_size)
         for name, val in data.items():
             self.all_fields[name].encode(tune, self, val)
         return tune
 
+    # Zero-copy typed views over the fixed area of the tune
+    def View(self, tune):
+        return TuneView(self, tune)
+
+    # The fixed area as a one element NumPy record array sharing the tune's
+    # memory; needs numpy
+    def StructuredView(self, tune):
+        import numpy
+        fields = {}
+        for f in self.all_fields.values():
+            if isinstance(f, Table):
+                fields[f.short_name] = ('u2', f.offset)
+            elif isinstance(f, Text):
+                fields[f.short_name] = ('S%d' % f.length, f.offset)
+            elif isinstance(f, Scalar):
+                fields[f.short_name] = (f.format, f.offset)
+            else:
+                fields[f.short_name] = ('u1', f.offset)
+        dtype = numpy.dtype({'names': list(fields),
+                             'formats': [v[0] for v in fields.values()],
+                             'offsets': [v[1] for v in fields.values()],
+                             'itemsize': self.table_offset})
+        return numpy.frombuffer(tune, dtype, 1)
+
+    # Drop cached table layouts and free space after the tune was modified
+    # behind our back
+    def InvalidateCaches(self):
+        for t in self.all_tables.values():
+            t.InvalidateLayout()
+        self.allocator = None
+        self.allocator_tune = None
+        self.table_spans_tune = None
+
+    def AddDependent(self, short_name):
+        if short_name not in self.dependents:
+            self.dependents[short_name] = Dependents()
+        return self.dependents[short_name]
+
+    def Dependents(self, short_name):
+        return self.dependents.get(short_name) or Dependents()
+
     def ProcessMenu(self, menu):
+        if SubstField(menu[1]):
+            self.AddDependent(SubstField(menu[1])).labels.append(menu[1])
         if menu[0] == 'submenu' or menu[0] == 'page':
             for m in menu[2:]:
                 self.ProcessMenu(m)
@@ -325,48 +729,204 @@ class Config:
             self.all_fields[c.short_name] = c
             if menu[0] == 'table':
                 self.all_tables[c.short_name] = c
+            if type(c.conditional) is str:
+                for n in self.CompileConditional(c.conditional)[1]:
+                    self.AddDependent(n).conditionals.append(c.short_name)
+
+    # Sorts the fields by the bytes they occupy, which must not overlap and
+    # must stay in the fixed area
+    def IndexFields(self):
+        spans = sorted([(f.offset, f.offset + f.size, f) for f in self.all_fields.values()],
+                       key=lambda s: s[:2])
+        end, last = 0, None
+        for b, e, f in spans:
+            if b < end:
+                raise ValueError('%s at %d overlaps %s' % (f.short_name, b, last.short_name))
+            if b < 0 or e > self.table_offset:
+                raise ValueError('%s at %d is outside the fixed area' % (f.short_name, b))
+            end, last = e, f
+        self.field_spans = spans
+        self.field_begins = [b for b, e, f in spans]
+
+    # Fields overlapping the fixed area bytes [begin, end), in offset order
+    def FieldsIn(self, begin, end):
+        i = max(bisect.bisect_right(self.field_begins, begin) - 1, 0)
+        fields = []
+        while i < len(self.field_spans) and self.field_spans[i][0] < end:
+            if self.field_spans[i][1] > begin:
+                fields.append(self.field_spans[i][2])
+            i += 1
+        return fields
+
+    # The field owning byte offset of the tune, or None.  Given the tune,
+    # bytes in the table region map to the table stored there.
+    def FieldAt(self, offset, tune=None):
+        if offset < self.table_offset:
+            fields = self.FieldsIn(offset, offset + 1)
+            return fields[0] if fields else None
+        if tune is not None:
+            spans = self.TableSpans(tune)
+            i = bisect.bisect_right(self.table_begins, offset) - 1
+            if i >= 0 and offset < spans[i][1]:
+                return self.all_tables[spans[i][2]]
+        return None
+
+    # Placed tables sorted by pointer.  Like the allocator this is kept for
+    # one tune and dropped whenever tables are placed, freed or moved.
+    def TableSpans(self, tune):
+        if self.table_spans_tune is not tune:
+            self.table_spans = sorted([(t.TablePtr(tune), t.TablePtr(tune) + t.TableLen(tune),
+                                        t.short_name)
+                                       for t in self.all_tables.values() if t.TablePtr(tune)])
+            self.table_begins = [b for b, e, n in self.table_spans]
+            self.table_spans_tune = tune
+        return self.table_spans
+
+    def CompileConditional(self, cond):
+        if cond not in self.conditionals:
+            names = sorted(set(n.id for n in ast.walk(ast.parse(cond, mode='eval'))
+                               if isinstance(n, ast.Name)))
+            self.conditionals[cond] = (compile(cond, '<conditional>', 'eval'), names)
+        return self.conditionals[cond]
 
     def EvalConditional(self, tune, cond):
-        class M:
-            def __init__(self, conf, tune):
-                self.conf = conf
-                self.tune = tune
-
-            def __getitem__(self, x):
-                return self.conf.all_fields[x].get(self.tune)
-        return eval(cond, {}, M(self, tune))
+        code, names = self.CompileConditional(cond)
+        return eval(code, {}, dict([(n, self.all_fields[n].get(tune))
+                                    for n in names if n in self.all_fields]))
+
+    def Allocator(self, tune):
+        if self.allocator_tune is not tune:
+            self.allocator = TableAllocator(self.table_offset, self.total_size)
+            self.allocator_tune = tune
+            for t in self.all_tables.values():
+                if t.TableLen(tune):
+                    self.allocator.Reserve(t.TablePtr(tune), t.TableLen(tune))
+        return self.allocator
 
     def GetFreeTableSpace(self, tune):
-        used = [(t.TablePtr(tune), t.TableLen(tune))
-                for t in self.all_tables.values()
-                if t.TableLen(tune) != 0]
-        used.sort()
-        used = [(self.table_offset, 0)] + used + [(self.total_size, 0)]
-        print("GetFreeTableSpace", used)
-        return [(a[0] + a[1], b[0])
-                for a, b in zip(used[:-1], used[1:])
-                if a[0] + a[1] != b[0]]
+        return list(self.Allocator(tune).ranges)
 
     def TotalFreeTableSpace(self, tune):
         return sum([e-b for b, e in self.GetFreeTableSpace(tune)])
 
-    def AllocateTable(self, tune, table_name, xexp, xvar_name, xbins, yexp, yvar_name, ybins):
+    def TableSpaceStats(self, tune):
+        return self.Allocator(tune).Stats()
+
+    # Return a table block that is no longer pointed to by any table
+    def ReleaseTableSpace(self, tune, ptr, size):
+        if size:
+            self.Allocator(tune).Release(ptr, size)
+
+    def BuildTable(self, table_name, xexp, xvar_name, xbins, yexp, yvar_name, ybins):
         xsize = 8 + 2 * len(xbins)
         ysize = 4 + 2 * len(ybins)
         dsize = int(abs(self.all_tables[table_name].encoding) *
                     max(len(xbins), 1) * max(len(ybins), 1) + 1.9) & -2
         tsize = xsize + ysize + dsize
         ret = bytearray(tsize)
-        struct.pack_into("BBBBBbH%dh" % len(xbins), ret, 0,
-                         0, 0, 0, 0,
-                         len(xbins), xexp, self.variables.index(xvar_name),
-                         *[int(round(b * 10 ** -xexp)) for b in xbins])
-        struct.pack_into("BbH%dh" % len(ybins), ret, xsize,
-                         len(ybins), yexp, self.variables.index(yvar_name),
-                         *[int(round(b * 10 ** -yexp)) for b in ybins])
-        for b, e in self.GetFreeTableSpace(tune):
-            if e - b >= tsize:
-                print("Allocated table %s at %d-%d" % (table_name, b, b+tsize))
-                tune[b : b+tsize] = ret
-                return b
-        return None # not enough memory available
+        Struct("BBBBBbH%dh" % len(xbins)).pack_into(ret, 0,
+                                                    0, 0, 0, 0,
+                                                    len(xbins), xexp,
+                                                    self.variable_index[xvar_name],
+                                                    *[int(round(b * 10 ** -xexp))
+                                                      for b in xbins])
+        Struct("BbH%dh" % len(ybins)).pack_into(ret, xsize,
+                                               len(ybins), yexp,
+                                               self.variable_index[yvar_name],
+                                               *[int(round(b * 10 ** -yexp))
+                                                 for b in ybins])
+        return ret
+
+    def AllocateTable(self, tune, table_name, xexp, xvar_name, xbins, yexp, yvar_name, ybins):
+        ret = self.BuildTable(table_name, xexp, xvar_name, xbins, yexp, yvar_name, ybins)
+        return self.PlaceTable(tune, table_name, ret)
+
+    def PlaceTable(self, tune, table_name, block):
+        self.all_tables[table_name].InvalidateLayout()
+        b = self.Allocator(tune).Allocate(len(block))
+        if b is None and self.TotalFreeTableSpace(tune) >= len(block):
+            self.CompactTables(tune)
+            b = self.Allocator(tune).Allocate(len(block))
+        if b is None:
+            return None # not enough memory available
+        tune[b : b+len(block)] = block
+        self.table_spans_tune = None
+        Written(tune, b, len(block))
+        return b
+
+    # Zero a table's block, return it to the free list and clear the pointer
+    def FreeTable(self, tune, table_name):
+        tbl = self.all_tables[table_name]
+        ptr, size = tbl.TablePtr(tune), tbl.TableLen(tune)
+        if not ptr:
+            return
+        tbl.setTablePtr(tune, 0)
+        self.table_spans_tune = None
+        tune[ptr : ptr+size] = bytes(size)
+        Written(tune, ptr, size)
+        self.ReleaseTableSpace(tune, ptr, size)
+
+    # Give a table new axes, keeping its interpolation settings.  The block is
+    # grown or shrunk in place when the space after it allows, otherwise it is
+    # moved and the old block freed.  Data is cleared.  Returns the table
+    # pointer, or None (with the table left untouched) if there is no room.
+    def ResizeTable(self, tune, table_name, xexp, xvar_name, xbins, yexp, yvar_name, ybins):
+        tbl = self.all_tables[table_name]
+        block = self.BuildTable(table_name, xexp, xvar_name, xbins, yexp, yvar_name, ybins)
+        ptr, size = tbl.TablePtr(tune), tbl.TableLen(tune)
+        if ptr:
+            block[0:3] = tune[ptr : ptr+3]
+            alloc = self.Allocator(tune)
+            if len(block) <= size or alloc.IsFree(ptr + size, len(block) - size):
+                alloc.Reserve(ptr, len(block))
+                tune[ptr : ptr+len(block)] = block
+                if len(block) < size:
+                    tune[ptr+len(block) : ptr+size] = bytes(size - len(block))
+                    alloc.Release(ptr + len(block), size - len(block))
+                tbl.InvalidateLayout()
+                self.table_spans_tune = None
+                Written(tune, ptr, max(size, len(block)))
+                return ptr
+        new = self.PlaceTable(tune, table_name, block)
+        if new is None and ptr:
+            ptr = tbl.TablePtr(tune) # compaction may have moved it
+            old = tune[ptr : ptr+size]
+            self.FreeTable(tune, table_name)
+            new = self.PlaceTable(tune, table_name, block)
+            if new is None:
+                self.Allocator(tune).Reserve(ptr, size)
+                tune[ptr : ptr+size] = old
+                Written(tune, ptr, size)
+                tbl.setTablePtr(tune, ptr)
+                self.table_spans_tune = None
+                return None
+        elif new is None:
+            return None
+        else:
+            self.FreeTable(tune, table_name)
+        tbl.setTablePtr(tune, new)
+        self.table_spans_tune = None
+        return new
+
+    # Slide all tables down to the start of the table region, closing the gaps
+    # between them.  Tables already in place are not touched.  Returns the
+    # byte ranges of the tune that changed.
+    def CompactTables(self, tune):
+        before = bytes(tune)
+        tables = sorted([t for t in self.all_tables.values() if t.TablePtr(tune)],
+                        key=lambda t: t.TablePtr(tune))
+        dest = self.table_offset
+        for t in tables:
+            ptr, size = t.TablePtr(tune), t.TableLen(tune)
+            if ptr != dest:
+                tune[dest : dest+size] = tune[ptr : ptr+size]
+                t.setTablePtr(tune, dest)
+            dest += size
+        tune[dest : self.total_size] = bytes(self.total_size - dest)
+        self.allocator = TableAllocator(dest, self.total_size)
+        self.allocator_tune = tune
+        self.table_spans_tune = None
+        changed = ChangedRanges(before, tune)
+        for b, e in changed:
+            Written(tune, b, e - b)
+        return changed
@@ -0,0 +1,194 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Datalogs of the variables channels, stored column-wise: a log is a
+# directory with one raw little-endian array per channel (<short_name>.bin)
+# and meta.json describing them.  Samples are kept as the ECU reports them,
+# integers of the variable's encoding with value = raw * 10**exponent, and
+# are memory-mapped on open so logs larger than RAM can be read in chunks.
+#
+# Logs are imported from CSV, with a header row of variable short names (or
+# full names), or from binary ECU logs, which are back to back realtime
+# frames with each variable at its offset.
+
+import realtime
+
+import csv
+import json
+import os
+
+import numpy
+
+meta_name = 'meta.json'
+
+def Dtype(var):
+    return numpy.dtype('<i%d' % (var.encoding // 8))
+
+# Layout of one realtime frame, variables may share bytes
+def FrameDtype(conf, names):
+    vars = [conf.all_variables[n] for n in names]
+    return numpy.dtype({'names': names,
+                        'formats': [Dtype(v) for v in vars],
+                        'offsets': [v.offset for v in vars],
+                        'itemsize': realtime.FrameSize(conf)})
+
+class LogWriter:
+    def __init__(self, path, conf, names):
+        self.path = path
+        self.conf = conf
+        self.names = names
+        self.samples = 0
+        os.makedirs(path, exist_ok=True)
+        self.files = dict([(n, open(os.path.join(path, n + '.bin'), 'wb')) for n in names])
+
+    # columns maps short_name to raw integer samples, all the same length
+    def AppendRaw(self, columns):
+        n = None
+        for name in self.names:
+            col = numpy.asarray(columns[name]).astype(Dtype(self.conf.all_variables[name]))
+            if n is not None and len(col) != n:
+                raise ValueError('channel %s has %d samples, expected %d' % (name, len(col), n))
+            n = len(col)
+            col.tofile(self.files[name])
+        self.samples += n or 0
+
+    # columns maps short_name to samples in engineering units; values are
+    # rounded to the channel resolution and saturated to its range
+    def Append(self, columns):
+        raw = {}
+        for name in self.names:
+            var = self.conf.all_variables[name]
+            info = numpy.iinfo(Dtype(var))
+            vals = numpy.asarray(columns[name], dtype=float) / 10.0 ** var.exponent
+            raw[name] = numpy.clip(numpy.rint(vals), info.min, info.max)
+        self.AppendRaw(raw)
+
+    def Close(self):
+        for f in self.files.values():
+            f.close()
+        meta = {'samples': self.samples, 'channels': {}}
+        for name in self.names:
+            var = self.conf.all_variables[name]
+            meta['channels'][name] = {'dtype': Dtype(var).str, 'exponent': var.exponent,
+                                      'units': var.units}
+        tmp = os.path.join(self.path, meta_name + '.tmp')
+        with open(tmp, 'wt') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, meta_name))
+        return Log(self.path)
+
+    # Gives up on a failed import: the channel files and any meta.json are
+    # removed, so the directory doesn't open as a truncated log, and so is
+    # the directory if nothing else is in it
+    def Abort(self):
+        for f in self.files.values():
+            f.close()
+        for name in [n + '.bin' for n in self.names] + [meta_name]:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+class Log:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, meta_name), 'rt') as f:
+            meta = json.load(f)
+        self.samples = meta['samples']
+        self.channels = meta['channels']
+        self.raw = {} # map short_name to memmap, opened on first use
+
+    def __len__(self):
+        return self.samples
+
+    def Raw(self, name):
+        if name not in self.raw:
+            if not self.samples:
+                self.raw[name] = numpy.zeros(0, dtype=self.channels[name]['dtype'])
+            else:
+                self.raw[name] = numpy.memmap(os.path.join(self.path, name + '.bin'), mode='r',
+                                              dtype=self.channels[name]['dtype'],
+                                              shape=(self.samples,))
+        return self.raw[name]
+
+    # Samples [start, stop) of a channel in engineering units
+    def Values(self, name, start=0, stop=None):
+        scale = 10.0 ** self.channels[name]['exponent']
+        return self.Raw(name)[start:stop] * scale
+
+    # Yields dicts mapping short_name to up to size samples in engineering
+    # units, e.g. for lookup.TableLookup.Evaluate or simulate.Simulator.Stream.
+    # Channels the log doesn't have are left out.
+    def Chunks(self, names=None, size=1 << 20):
+        names = [n for n in (names or self.channels) if n in self.channels]
+        for start in range(0, self.samples, size):
+            yield dict([(n, self.Values(n, start, start + size)) for n in names])
+
+# Imports a CSV log into a new log directory, chunk rows at a time.  Columns
+# that aren't variables (e.g. time) are skipped.
+def ImportCsv(path, conf, csv_path, chunk=65536):
+    by_name = dict([(v.name, v.short_name) for v in conf.all_variables.values() if v.short_name])
+    with open(csv_path, 'rt', newline='') as f:
+        reader = csv.reader(f)
+        header = [h.strip() for h in next(reader)]
+        cols = [(i, by_name.get(h, h)) for i, h in enumerate(header)
+                if by_name.get(h, h) in conf.all_variables and by_name.get(h, h)]
+        writer = LogWriter(path, conf, [n for i, n in cols])
+        try:
+            rows = []
+            for row in reader:
+                if not row:
+                    continue
+                rows.append([row[i] for i, n in cols])
+                if len(rows) == chunk:
+                    writer.Append(CsvColumns(rows, cols))
+                    rows = []
+            if rows:
+                writer.Append(CsvColumns(rows, cols))
+        except:
+            writer.Abort()
+            raise
+    return writer.Close()
+
+def CsvColumns(rows, cols):
+    data = numpy.array(rows, dtype=float).reshape(len(rows), len(cols))
+    return dict([(n, data[:, j]) for j, (i, n) in enumerate(cols)])
+
+# Imports a binary ECU log of realtime frames, names defaults to every
+# variable
+def ImportBinary(path, conf, bin_path, names=None, chunk=65536):
+    names = names or [v for v in conf.variables if v]
+    frame = FrameDtype(conf, names)
+    writer = LogWriter(path, conf, names)
+    try:
+        with open(bin_path, 'rb') as f:
+            while True:
+                data = f.read(frame.itemsize * chunk)
+                if len(data) % frame.itemsize:
+                    raise ValueError('%s: truncated frame at the end' % bin_path)
+                if not data:
+                    break
+                frames = numpy.frombuffer(data, dtype=frame)
+                writer.AppendRaw(dict([(n, frames[n]) for n in names]))
+    except:
+        writer.Abort()
+        raise
+    return writer.Close()
@@ -0,0 +1,282 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Talking to the ECU.  Every exchange is one request frame and one reply
+# frame:
+#
+#   request: command, sequence, offset, length [, data for writes]
+#   reply:   command (or ERROR), sequence, offset, length, crc32 [, data for reads]
+#
+# READ and WRITE address the tune, REALTIME reads the block of live variable
+# values (see Variable.offset).  The crc32 covers the bytes as the ECU holds
+# them after the request, so both reads and writes can be verified.  The
+# transports only move frames; Emulator implements the ECU side for testing
+# without hardware.
+
+import config
+
+import socket
+import struct
+import zlib
+
+READ = b'R'
+WRITE = b'W'
+REALTIME = b'V'
+ERROR = b'E'
+
+# Commands whose reply carries data
+with_data = (READ, REALTIME)
+
+request = struct.Struct('<cHIH')
+reply = struct.Struct('<cHIHI')
+
+# offset is where in the tune (or realtime block) the failed request was
+class EcuError(Exception):
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+# Validates a reply frame against its request, returns the data read or written
+def CheckReply(resp, cmd, seq, offset, length, data=b''):
+    rcmd, rseq, roffset, rlength, crc = reply.unpack_from(resp, 0)
+    if rcmd == ERROR:
+        raise EcuError('ECU rejected %s of %d bytes at %d' % (cmd.decode(), length, offset),
+                       offset)
+    if (rcmd, rseq, roffset, rlength) != (cmd, seq, offset, length):
+        raise EcuError('unexpected reply to %s at %d' % (cmd.decode(), offset), offset)
+    data = bytes(resp[reply.size:]) if cmd in with_data else bytes(data)
+    if zlib.crc32(data) != crc:
+        raise EcuError('checksum mismatch at %d' % offset, offset)
+    return data
+
+class Emulator:
+    def __init__(self, size, realtime_size=256):
+        self.image = bytearray(size)
+        self.realtime = bytearray(realtime_size) # live variable values
+        self.frames = 0
+        self.bytes_written = 0
+
+    # Takes one complete request frame, returns the reply frame
+    def Handle(self, frame):
+        cmd, seq, offset, length = request.unpack_from(frame, 0)
+        self.frames += 1
+        if cmd == REALTIME and offset + length <= len(self.realtime):
+            data = bytes(self.realtime[offset : offset+length])
+            return reply.pack(cmd, seq, offset, length, zlib.crc32(data)) + data
+        if offset + length > len(self.image) or cmd not in (READ, WRITE):
+            return reply.pack(ERROR, seq, offset, length, 0)
+        if cmd == WRITE:
+            data = frame[request.size : request.size + length]
+            if len(data) != length:
+                return reply.pack(ERROR, seq, offset, length, 0)
+            self.image[offset : offset+length] = data
+            self.bytes_written += length
+        data = bytes(self.image[offset : offset+length])
+        return reply.pack(cmd, seq, offset, length, zlib.crc32(data)) + (
+            data if cmd == READ else b'')
+
+class EmulatorTransport:
+    def __init__(self, emulator):
+        self.emulator = emulator
+
+    def Transact(self, frame):
+        return self.emulator.Handle(frame)
+
+    def Close(self):
+        pass
+
+# Shared framing for byte stream transports
+class StreamTransport:
+    def Transact(self, frame):
+        self.Send(frame)
+        hdr = self.RecvExact(reply.size)
+        cmd, seq, offset, length, crc = reply.unpack(hdr)
+        if cmd in with_data:
+            return hdr + self.RecvExact(length)
+        return hdr
+
+    def RecvExact(self, n):
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.Recv(n - len(buf))
+            if not chunk:
+                raise EcuError('connection closed')
+            buf += chunk
+        return bytes(buf)
+
+class TcpTransport(StreamTransport):
+    def __init__(self, host, port, timeout=2.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def Send(self, data):
+        self.sock.sendall(data)
+
+    def Recv(self, n):
+        return self.sock.recv(n)
+
+    def Close(self):
+        self.sock.close()
+
+class SerialTransport(StreamTransport):
+    def __init__(self, port, baudrate=115200, timeout=2.0):
+        try:
+            import serial # pyserial, only needed for this transport
+        except ImportError:
+            raise EcuError('serial transport needs pyserial')
+        self.port = serial.Serial(port, baudrate, timeout=timeout)
+
+    def Send(self, data):
+        self.port.write(data)
+
+    def Recv(self, n):
+        return self.port.read(n)
+
+    def Close(self):
+        self.port.close()
+
+# spec is 'emulator', 'tcp:host:port' or 'serial:device[:baudrate]'
+def OpenTransport(spec, size):
+    kind, _, args = spec.partition(':')
+    if kind == 'emulator':
+        return EmulatorTransport(Emulator(size))
+    if kind == 'tcp':
+        host, _, port = args.rpartition(':')
+        return TcpTransport(host, int(port))
+    if kind == 'serial':
+        args = args.split(':')
+        return SerialTransport(args[0], *[int(a) for a in args[1:]])
+    raise ValueError('unknown ECU transport %s' % spec)
+
+# Ecu for a transport spec.  Links that have to connect (tcp, serial) are
+# opened on first use rather than here, so a missing ECU only fails the
+# requests and not whatever is being set up.
+def Open(spec, size, block=256):
+    kind = spec.partition(':')[0]
+    if kind == 'emulator':
+        return Ecu(OpenTransport(spec, size), block)
+    if kind not in ('tcp', 'serial'):
+        raise ValueError('unknown ECU transport %s' % spec)
+    return Ecu(lambda: OpenTransport(spec, size), block)
+
+class Ecu:
+    # transport is a transport, or a function opening one on first use
+    def __init__(self, transport, block=256):
+        self.opener = transport if callable(transport) else None
+        self.transport = None if self.opener else transport
+        self.block = block
+        self.seq = 0
+        self.frames = 0
+        self.bytes_sent = 0
+
+    def Transport(self):
+        if self.transport is None:
+            self.transport = self.opener()
+        return self.transport
+
+    # After a failed exchange the reply may still be on its way; the link is
+    # reopened for the next request so the late reply isn't taken for its
+    # own.  Transports without an opener are in-process and can't lag.
+    def Drop(self):
+        if self.opener and self.transport:
+            try:
+                self.transport.Close()
+            except OSError:
+                pass
+            self.transport = None
+
+    def Transact(self, cmd, offset, length, data=b''):
+        self.seq = (self.seq + 1) & 0xffff
+        frame = request.pack(cmd, self.seq, offset, length) + data
+        try:
+            resp = self.Transport().Transact(frame)
+            self.frames += 1
+            self.bytes_sent += len(frame)
+            return CheckReply(resp, cmd, self.seq, offset, length, data)
+        except (OSError, EcuError):
+            self.Drop()
+            raise
+
+    def Read(self, offset, length):
+        return b''.join([self.Transact(READ, o, min(self.block, offset + length - o))
+                         for o in range(offset, offset + length, self.block)])
+
+    # Live variable values, in one request
+    def ReadRealtime(self, offset, length):
+        return self.Transact(REALTIME, offset, length)
+
+    def Write(self, offset, data):
+        data = memoryview(data)
+        for o in range(0, len(data), self.block):
+            self.Transact(WRITE, offset + o, len(data[o : o+self.block]),
+                          data[o : o+self.block])
+
+# Sorted, non-overlapping [begin, end) ranges of changed bytes
+class DirtyRanges(config.RangeSet):
+    # Merge ranges separated by at most gap clean bytes (cheaper to resend
+    # than to pay for another frame), then split to at most block bytes
+    def Coalesce(self, gap, block):
+        merged = []
+        for b, e in self.ranges:
+            if merged and b - merged[-1][1] <= gap:
+                merged[-1][1] = e
+            else:
+                merged.append([b, e])
+        return [(o, min(o + block, e)) for b, e in merged for o in range(b, e, block)]
+
+# Tracks what changed in a tune since it was last stored and sends only
+# those bytes.  Until the first Store the ECU contents are unknown, so the
+# whole tune counts as dirty.
+class TuneStore:
+    def __init__(self, tune, ecu):
+        self.tune = tune
+        self.ecu = ecu
+        self.dirty = DirtyRanges()
+        self.dirty.Add(0, len(tune))
+        tune.watchers.append(self.dirty.Add)
+
+    def Pending(self):
+        return self.dirty.Coalesce(request.size + reply.size, self.ecu.block)
+
+    # Snapshot of the dirty blocks as [(offset, data)], which are then
+    # considered clean.  Hand them back to Failed if sending them fails.
+    def Take(self):
+        blocks = [(b, bytes(self.tune[b:e])) for b, e in self.Pending()]
+        self.dirty.Clear()
+        return blocks
+
+    def Failed(self, blocks):
+        for b, data in blocks:
+            self.dirty.Add(b, len(data))
+
+    # Returns the number of tune bytes sent
+    def Store(self):
+        blocks = self.Take()
+        try:
+            for b, data in blocks:
+                self.ecu.Write(b, data)
+        except:
+            self.Failed(blocks)
+            raise
+        return sum([len(data) for b, data in blocks])
+
+    # The ECU is known to hold the same image, e.g. it was just read back
+    def MarkClean(self):
+        self.dirty.Clear()
+
+    def Close(self):
+        self.tune.watchers.remove(self.dirty.Add)
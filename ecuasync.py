@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# asyncio version of the ECU link in ecu.py, speaking the same frames.  Up
+# to window requests are kept in flight and matched to replies by sequence
+# number, so link latency is paid once per window instead of once per
+# block.  LinkThread runs the event loop next to the Qt one.
+#
+#   ./ecuasync.py serve [--port N] [config]   stand-in ECU over TCP
+#   ./ecuasync.py bench [--port N] [config]   throughput/latency against it
+
+import ecu
+import tunefile
+
+import argparse
+import asyncio
+import threading
+import time
+
+class AsyncEcu:
+    def __init__(self, reader, writer, block=256, window=8):
+        self.reader = reader
+        self.writer = writer
+        self.block = block
+        self.window = asyncio.Semaphore(window)
+        self.seq = 0
+        self.pending = {} # map sequence to (future, request)
+        self.receiver = asyncio.ensure_future(self.Receive())
+
+    @classmethod
+    async def Connect(cls, host, port, **kwargs):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, **kwargs)
+
+    async def Receive(self):
+        try:
+            while True:
+                hdr = await self.reader.readexactly(ecu.reply.size)
+                cmd, seq, offset, length, crc = ecu.reply.unpack(hdr)
+                if cmd in ecu.with_data:
+                    hdr += await self.reader.readexactly(length)
+                fut, req = self.pending.pop(seq, (None, None))
+                if fut is None:
+                    raise ecu.EcuError('reply to unknown request %d' % seq)
+                try:
+                    fut.set_result(ecu.CheckReply(hdr, *req))
+                except ecu.EcuError as e:
+                    fut.set_exception(e)
+        except (asyncio.IncompleteReadError, ConnectionError, ecu.EcuError) as e:
+            for fut, req in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(ecu.EcuError('link lost: %s' % e))
+            self.pending = {}
+
+    async def Transact(self, cmd, offset, length, data=b''):
+        async with self.window:
+            if self.receiver.done():
+                raise ecu.EcuError('link closed')
+            self.seq = (self.seq + 1) & 0xffff
+            fut = asyncio.get_running_loop().create_future()
+            self.pending[self.seq] = (fut, (cmd, self.seq, offset, length, bytes(data)))
+            self.writer.write(ecu.request.pack(cmd, self.seq, offset, length) + data)
+            await self.writer.drain()
+            return await fut
+
+    async def Read(self, offset, length):
+        return b''.join(await asyncio.gather(*[
+            self.Transact(ecu.READ, o, min(self.block, offset + length - o))
+            for o in range(offset, offset + length, self.block)]))
+
+    async def ReadRealtime(self, offset, length):
+        return await self.Transact(ecu.REALTIME, offset, length)
+
+    # blocks is [(offset, data)], e.g. from ecu.TuneStore.Take
+    async def Write(self, blocks):
+        await asyncio.gather(*[
+            self.Transact(ecu.WRITE, b + o, len(data[o : o+self.block]),
+                          data[o : o+self.block])
+            for b, data in blocks for o in range(0, len(data), self.block)])
+
+    async def Close(self):
+        self.receiver.cancel()
+        self.writer.close()
+        await self.writer.wait_closed()
+
+async def ServeClient(emulator, reader, writer):
+    try:
+        while True:
+            frame = await reader.readexactly(ecu.request.size)
+            cmd, seq, offset, length = ecu.request.unpack(frame)
+            if cmd == ecu.WRITE:
+                frame += await reader.readexactly(length)
+            writer.write(emulator.Handle(frame))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    writer.close()
+
+async def Serve(emulator, host='127.0.0.1', port=5555):
+    return await asyncio.start_server(
+        lambda r, w: ServeClient(emulator, r, w), host, port)
+
+# Runs an event loop on a worker thread.  Submit returns a
+# concurrent.futures.Future; connect its done callback to a queued Qt signal
+# to get the result back on the GUI thread.
+class LinkThread(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def Submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def Stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+# An AsyncEcu on its own LinkThread, connecting on first use.  Store can be
+# called from the GUI thread and never blocks.
+class ThreadedLink:
+    def __init__(self, host, port, block=256, window=8):
+        self.host = host
+        self.port = port
+        self.block = block
+        self.window = window
+        self.link = None
+        self.connecting = None # asyncio.Lock, made on the link thread
+        self.thread = LinkThread()
+
+    # Requests made while connecting wait for the same connection, so they
+    # all go out on one socket in the order they were made
+    async def Connected(self):
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+        async with self.connecting:
+            if self.link is None or self.link.receiver.done():
+                if self.link is not None:
+                    try:
+                        await self.link.Close()
+                    except OSError:
+                        pass
+                    self.link = None
+                self.link = await AsyncEcu.Connect(self.host, self.port,
+                                                   block=self.block, window=self.window)
+        return self.link
+
+    async def WriteBlocks(self, blocks):
+        await (await self.Connected()).Write(blocks)
+
+    # blocks is [(offset, data)], returns a concurrent.futures.Future
+    def Store(self, blocks):
+        return self.thread.Submit(self.WriteBlocks(blocks))
+
+    async def ReadRealtimeBlock(self, offset, length):
+        return await (await self.Connected()).ReadRealtime(offset, length)
+
+    # Returns a concurrent.futures.Future of the live variable bytes
+    def ReadRealtime(self, offset, length):
+        return self.thread.Submit(self.ReadRealtimeBlock(offset, length))
+
+async def Bench(host, port, size, rounds=20):
+    results = {}
+    for window in (1, 4, 16):
+        link = await AsyncEcu.Connect(host, port, window=window)
+        start = time.perf_counter()
+        for i in range(rounds):
+            await link.Read(0, size)
+        elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in range(rounds):
+            await link.Transact(ecu.READ, 0, 1)
+        latency = (time.perf_counter() - start) / rounds
+        await link.Close()
+        results[window] = (size * rounds / elapsed, latency)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in ECU and link benchmark')
+    parser.add_argument('mode', choices=['serve', 'bench'])
+    parser.add_argument('config', nargs='?', default='config.json')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5555)
+    args = parser.parse_intermixed_args()
+
+    size = tunefile.LoadAny(args.config)[0].total_size
+
+    async def run():
+        if args.mode == 'serve':
+            server = await Serve(ecu.Emulator(size), args.host, args.port)
+            async with server:
+                await server.serve_forever()
+        else:
+            for window, (rate, latency) in (await Bench(args.host, args.port, size)).items():
+                print('window %2d: %8.0f bytes/s, %.3f ms round trip' %
+                      (window, rate, latency * 1000))
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main()
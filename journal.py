@@ -0,0 +1,148 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Undo/redo for a tune.  The journal watches the tune and keeps a shadow
+# copy of it, so every reported write becomes a delta (offset, old bytes,
+# new bytes) without snapshotting the image.  Deltas made inside a Group
+# are undone together; a write outside of one is an action by itself.
+#
+# Undo and redo report what they change to the tune watchers like any other
+# write, so table grids and the ECU dirty ranges follow along.  Writes that
+# bypass the watchers (memoryviews) aren't journaled.
+
+import config
+
+class Action:
+    def __init__(self, label):
+        self.label = label
+        self.deltas = [] # (offset, old bytes, new bytes) in the order written
+        self.size = 0
+
+    def Add(self, offset, old, new):
+        self.deltas.append((offset, old, new))
+        self.size += len(old) + len(new)
+
+class Journal:
+    def __init__(self, conf, tune, limit=1 << 20):
+        self.conf = conf
+        self.tune = tune
+        self.limit = limit # bytes of deltas kept, oldest actions are dropped
+        self.shadow = bytearray(tune)
+        self.undo = []
+        self.redo = []
+        self.size = 0
+        self.current = None # Action being recorded
+        self.depth = 0
+        self.replaying = False
+        tune.watchers.append(self.written)
+
+    def Close(self):
+        self.tune.watchers.remove(self.written)
+
+    def written(self, offset, size):
+        new = bytes(self.tune[offset : offset+size])
+        old = bytes(self.shadow[offset : offset+size])
+        self.shadow[offset : offset+size] = new
+        if self.replaying or old == new:
+            return
+        if self.current is None:
+            action = Action('Edit')
+            action.Add(offset, old, new)
+            self.Push(action)
+        else:
+            self.current.Add(offset, old, new)
+
+    def Push(self, action):
+        self.undo.append(action)
+        self.size += action.size
+        self.size -= sum([a.size for a in self.redo])
+        self.redo = []
+        while self.size > self.limit and len(self.undo) > 1:
+            self.size -= self.undo.pop(0).size
+
+    # Groups the writes of one user level change:
+    #
+    #   with journal.Group('Change axis'):
+    #       ...
+    #
+    # Nested groups belong to the outermost one.
+    def Group(self, label):
+        return Grouper(self, label)
+
+    def Begin(self, label):
+        if not self.depth:
+            self.current = Action(label)
+        self.depth += 1
+
+    def End(self):
+        self.depth -= 1
+        if not self.depth:
+            action, self.current = self.current, None
+            if action.deltas:
+                self.Push(action)
+
+    def CanUndo(self):
+        return bool(self.undo)
+
+    def CanRedo(self):
+        return bool(self.redo)
+
+    def UndoLabel(self):
+        return self.undo[-1].label if self.undo else None
+
+    def RedoLabel(self):
+        return self.redo[-1].label if self.redo else None
+
+    # Undo and Redo return the (offset, size) ranges they rewrote, or None
+    # when there is nothing to do
+    def Undo(self):
+        if not self.undo:
+            return None
+        action = self.undo.pop()
+        self.redo.append(action)
+        return self.Replay([(o, old) for o, old, new in reversed(action.deltas)])
+
+    def Redo(self):
+        if not self.redo:
+            return None
+        action = self.redo.pop()
+        self.undo.append(action)
+        return self.Replay([(o, new) for o, old, new in action.deltas])
+
+    def Replay(self, writes):
+        for o, data in writes:
+            self.tune[o : o+len(data)] = data
+        # Table pointers and headers may have changed under the caches
+        self.conf.InvalidateCaches()
+        self.replaying = True
+        try:
+            for o, data in writes:
+                config.Written(self.tune, o, len(data))
+        finally:
+            self.replaying = False
+        return [(o, len(data)) for o, data in writes]
+
+class Grouper:
+    def __init__(self, journal, label):
+        self.journal = journal
+        self.label = label
+
+    def __enter__(self):
+        self.journal.Begin(self.label)
+
+    def __exit__(self, *exc):
+        self.journal.End()
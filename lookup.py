@@ -0,0 +1,77 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Evaluates tables at operating points the way the ECU would: binary search
+# on the axis bins, linear blending between neighbouring bins, and clamping
+# to the first/last bin outside the axis range.  Everything works on NumPy
+# arrays so whole logs can be evaluated at once.
+
+import numpy
+
+# For each value, the index of the bin at or below it and how far it is
+# towards the next bin (0..1).  Bins must be ascending.
+def Locate(bins, vals):
+    bins = numpy.asarray(bins, dtype=float)
+    vals = numpy.asarray(vals, dtype=float)
+    if len(bins) < 2:
+        return numpy.zeros(vals.shape, dtype=numpy.intp), numpy.zeros(vals.shape)
+    i = numpy.clip(numpy.searchsorted(bins, vals, side='right') - 1, 0, len(bins) - 2)
+    width = numpy.diff(bins)
+    scale = numpy.divide(1, width, out=numpy.zeros(width.shape), where=width > 0)
+    frac = (vals - bins.take(i)) * scale.take(i)
+    return i, numpy.clip(frac, 0, 1)
+
+# Snapshot of one table; rebuild it after the table is edited
+class TableLookup:
+    def __init__(self, conf, tune, table_name):
+        tbl = conf.all_tables[table_name]
+        self.name = table_name
+        self.xvar = tbl.AxisShortName(conf, tune, 0)
+        self.yvar = tbl.AxisShortName(conf, tune, 1)
+        self.xbins = numpy.array(tbl.AxisBins(tune, 0), dtype=float)
+        self.ybins = numpy.array(tbl.AxisBins(tune, 1), dtype=float)
+        self.data = numpy.array(tbl.DataBlock(tune) or [[0]], dtype=float) # [y][x]
+
+    # Fractional (row, column) position of each operating point, for
+    # showing a cursor on the grid
+    def Position(self, x=0, y=0):
+        ix, fx = Locate(self.xbins, x)
+        iy, fy = Locate(self.ybins, y)
+        return iy + fy, ix + fx
+
+    def __call__(self, x=0, y=0):
+        x, y = numpy.broadcast_arrays(numpy.asarray(x, dtype=float),
+                                      numpy.asarray(y, dtype=float))
+        h, w = self.data.shape
+        ix, fx = Locate(self.xbins, x)
+        iy, fy = Locate(self.ybins, y)
+        # Neighbouring cells as offsets into the flattened data, Locate
+        # never returns the last bin so they stay in range
+        flat = self.data.ravel()
+        base = iy * w + ix
+        dx = 1 if w > 1 else 0
+        dy = w if h > 1 else 0
+        top = flat.take(base)
+        top += (flat.take(base + dx) - top) * fx
+        bottom = flat.take(base + dy)
+        bottom += (flat.take(base + dy + dx) - bottom) * fx
+        return top + (bottom - top) * fy
+
+    # values maps variable short_name to an array of samples, missing
+    # variables read as 0
+    def Evaluate(self, values):
+        return self(values.get(self.xvar, 0), values.get(self.yvar, 0))
@@ -0,0 +1,125 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Math block expressions.  The text is parsed once and checked against what
+# the ECU supports: numbers, the arguments A to D (either case), + - * / //
+# % **, unary + and -, and comparisons, which give 1 or 0.  The checked tree
+# is compiled to Python code operating on NumPy arrays, so a whole log is
+# evaluated with one call.
+
+import ast
+import functools
+
+import numpy
+
+args = ('a', 'b', 'c', 'd')
+
+binops = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+unaryops = (ast.UAdd, ast.USub)
+cmpops = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+# Checks the tree and rewrites it so it works on arrays: names are lower
+# cased, numbers become NumPy floats (so constant only expressions can't
+# raise or run away with huge integers either) and comparison chains, which
+# Python would evaluate with 'and', become logical_and of the single
+# comparisons, converted to float 1 or 0 so they can take part in arithmetic.
+class Checker(ast.NodeTransformer):
+    def __init__(self):
+        self.ops = 0
+
+    def generic_visit(self, node):
+        raise ValueError('%s not allowed in math expression' % type(node).__name__)
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_Constant(self, node):
+        if type(node.value) not in (int, float):
+            raise ValueError('%r not allowed in math expression' % (node.value,))
+        try:
+            value = float(node.value)
+        except OverflowError:
+            raise ValueError('%r too large in math expression' % (node.value,))
+        return ast.copy_location(ast.Call(ast.Name('num', ast.Load()),
+                                          [ast.Constant(value)], []), node)
+
+    def visit_Name(self, node):
+        if node.id.lower() not in args:
+            raise ValueError('unknown name %s in math expression' % node.id)
+        return ast.copy_location(ast.Name(node.id.lower(), ast.Load()), node)
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, binops):
+            raise ValueError('%s not allowed in math expression' % type(node.op).__name__)
+        self.ops += 1
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, unaryops):
+            raise ValueError('%s not allowed in math expression' % type(node.op).__name__)
+        self.ops += 1
+        node.operand = self.visit(node.operand)
+        return node
+
+    def visit_Compare(self, node):
+        for op in node.ops:
+            if not isinstance(op, cmpops):
+                raise ValueError('%s not allowed in math expression' % type(op).__name__)
+        self.ops += len(node.ops)
+        operands = [self.visit(n) for n in [node.left] + node.comparators]
+        single = [ast.Compare(operands[i], [op], [operands[i + 1]])
+                  for i, op in enumerate(node.ops)]
+        res = single[0]
+        for c in single[1:]:
+            res = ast.Call(ast.Name('logical_and', ast.Load()), [res, c], [])
+        res = ast.Call(ast.Name('num', ast.Load()), [res], [])
+        return ast.copy_location(res, node)
+
+def Number(x):
+    return numpy.asarray(x, dtype=float)
+
+class Expression:
+    def __init__(self, text):
+        self.text = text
+        try:
+            tree = ast.parse(text.strip() or '0', mode='eval')
+        except SyntaxError as e:
+            raise ValueError('bad math expression %r: %s' % (text, e.msg))
+        checker = Checker()
+        tree = ast.fix_missing_locations(checker.visit(tree))
+        self.ops = checker.ops # operations per sample, a rough firmware cost
+        self.names = sorted(set(n.id for n in ast.walk(tree) if isinstance(n, ast.Name))
+                            & set(args))
+        self.code = compile(tree, '<math block>', 'eval')
+        if not self.names and not numpy.all(numpy.isfinite(self())):
+            raise ValueError('math expression %r is not finite' % text)
+
+    # a to d are scalars or arrays; missing arguments read as 0
+    def __call__(self, a=0, b=0, c=0, d=0):
+        scope = {'a': numpy.asarray(a, dtype=float), 'b': numpy.asarray(b, dtype=float),
+                 'c': numpy.asarray(c, dtype=float), 'd': numpy.asarray(d, dtype=float),
+                 'logical_and': numpy.logical_and, 'num': Number}
+        with numpy.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            return numpy.asarray(eval(self.code, {'__builtins__': {}}, scope), dtype=float)
+
+# Compiled expressions are shared, math blocks usually hold the same few
+@functools.lru_cache(maxsize=256)
+def Compile(text):
+    return Expression(text)
@@ -0,0 +1,113 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Live variable values.  The ECU keeps every variable at its offset in one
+# realtime block, which is read with a single REALTIME request per poll and
+# decoded with one precompiled struct.  Variables may share a slot (e.g. an
+# input selectable as either of two sensors); those are read once and
+# handed out under every name.
+
+import math
+import struct
+
+formats = {8: 'b', 16: 'h', 32: 'i'}
+
+# Bytes of the realtime block covering every variable
+def FrameSize(conf):
+    return max([v.offset + v.encoding // 8 for v in conf.all_variables.values() if v.short_name])
+
+class Decoder:
+    def __init__(self, conf):
+        slots = {} # map (offset, encoding) to [Variable]
+        for v in conf.all_variables.values():
+            if v.short_name:
+                slots.setdefault((v.offset, v.encoding), []).append(v)
+        self.size = FrameSize(conf)
+        # Slots that overlap without matching can't be in the same struct,
+        # they are decoded one by one
+        fmt = '<'
+        pos = 0
+        self.slots = [] # [Variable] for each field of the struct
+        self.extra = [] # (struct, offset, [Variable]) for overlapping slots
+        for (offset, encoding), vars in sorted(slots.items()):
+            if offset < pos:
+                self.extra.append((struct.Struct('<' + formats[encoding]), offset, vars))
+                continue
+            fmt += 'x' * (offset - pos) + formats[encoding]
+            pos = offset + encoding // 8
+            self.slots.append(vars)
+        self.struct = struct.Struct(fmt)
+
+    # Returns a dict mapping variable short_name to its value
+    def Decode(self, frame):
+        values = {}
+        for vars, raw in zip(self.slots, self.struct.unpack_from(frame, 0)):
+            for v in vars:
+                values[v.short_name] = raw * 10 ** v.exponent
+        for s, offset, vars in self.extra:
+            raw = s.unpack_from(frame, offset)[0]
+            for v in vars:
+                values[v.short_name] = raw * 10 ** v.exponent
+        return values
+
+# Fans decoded realtime frames out to subscribers.  The transport is up to
+# the caller: Poll reads through an ecu.Ecu, asynchronous links hand the
+# frame to Publish when it arrives.
+class Poller:
+    def __init__(self, conf, rate=50):
+        self.decoder = Decoder(conf)
+        self.rate = rate # polls per second
+        self.subscribers = []
+        self.values = {}
+
+    def Interval(self):
+        return 1 / self.rate
+
+    def Subscribe(self, func):
+        self.subscribers.append(func)
+
+    def Unsubscribe(self, func):
+        if func in self.subscribers:
+            self.subscribers.remove(func)
+
+    def Publish(self, frame):
+        self.values = self.decoder.Decode(frame)
+        for func in list(self.subscribers):
+            func(self.values)
+        return self.values
+
+    def Poll(self, link):
+        return self.Publish(link.ReadRealtime(0, self.decoder.size))
+
+# Moves the emulator's live values around so there is something to watch
+# without an engine.  Each variable sweeps its own range at its own pace.
+class Sweep:
+    def __init__(self, conf, emulator):
+        self.conf = conf
+        self.emulator = emulator
+        self.start = None
+
+    def Update(self, now):
+        if self.start is None:
+            self.start = now
+        t = now - self.start
+        for i, v in enumerate([v for v in self.conf.all_variables.values() if v.short_name]):
+            span = 7000 if v.units == 'RPM' else 250 if v.units == 'kPa' else 100
+            val = span * (0.5 + 0.5 * math.sin(t * (0.3 + 0.17 * i) + i))
+            raw = int(round(val * 10 ** -v.exponent))
+            struct.pack_into('<' + formats[v.encoding], self.emulator.realtime, v.offset,
+                             max(min(raw, (1 << (v.encoding - 1)) - 1), -(1 << (v.encoding - 1))))
@@ -0,0 +1,145 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Runs a whole tune over batches of input samples: every enabled table and
+# math block is evaluated in dependency order, honoring table links, so the
+# outputs of one can feed the axes or links of another.
+#
+# Which variable a table or math block drives isn't stored explicitly; they
+# share the $name substitution of their labels ("User Table 1$user_tbl1_name"
+# feeds "User Tables::Table 1$user_tbl1_name").
+
+import config
+import lookup
+import mathexpr
+
+import numpy
+
+NONE, INTERPOLATE, ADD_PERCENT, ADD, SWITCH = range(5)
+
+class TableNode:
+    def __init__(self, conf, tune, tbl, output):
+        self.name = tbl.short_name
+        self.output = output
+        self.lookup = lookup.TableLookup(conf, tune, tbl.short_name)
+        self.mode = tbl.Interpolate(tune)
+        self.b = tbl.InterpolateVar(tune, conf, 0) or None
+        self.c = tbl.InterpolateVar(tune, conf, 1) or None
+        self.inputs = [v for v in (self.lookup.xvar, self.lookup.yvar) if v]
+        if self.mode != NONE and self.b:
+            self.inputs.append(self.b)
+        if self.mode in (INTERPOLATE, SWITCH) and self.c:
+            self.inputs.append(self.c)
+
+    def Evaluate(self, values):
+        a = self.lookup.Evaluate(values)
+        b = values[self.b] if self.b else 0
+        c = values[self.c] if self.c else 0
+        if self.mode == INTERPOLATE:
+            return a + (c - a) * b / 100
+        if self.mode == ADD_PERCENT:
+            return (1 + a / 100) * b
+        if self.mode == ADD:
+            return a + b
+        if self.mode == SWITCH:
+            return numpy.where(b != 0, a, c)
+        return a
+
+class MathNode:
+    def __init__(self, conf, tune, page, output):
+        self.name = page[1]
+        self.output = output
+        fields = [conf.all_fields[f[2]] for f in page[2:]]
+        self.expr = [f for f in fields if f.short_name.endswith('_expr')][0].get(tune)
+        self.args = [f.get(tune, conf) for f in fields if isinstance(f, config.VarSelect)]
+        self.code = mathexpr.Compile(self.expr)
+        self.inputs = [v for v, letter in zip(self.args, mathexpr.args)
+                       if v and letter in self.code.names]
+
+    def Evaluate(self, values):
+        return self.code(*[values[v] if v else 0 for v in self.args])
+
+class Simulator:
+    def __init__(self, conf, tune):
+        outputs = {} # map $field to variable short_name
+        for v in conf.all_variables.values():
+            if config.SubstField(v.name):
+                outputs[config.SubstField(v.name)] = v.short_name
+        self.nodes = []
+        self.FindNodes(conf, tune, conf.menu, outputs)
+        produced = set([n.output for n in self.nodes if n.output])
+        self.inputs = [v for v in conf.variables if v and v not in produced]
+        self.order = self.Sort()
+
+    def FindNodes(self, conf, tune, menus, outputs):
+        for m in menus:
+            if m[0] == 'submenu':
+                self.FindNodes(conf, tune, m[2:], outputs)
+            elif m[0] == 'table':
+                tbl = conf.all_tables[m[2]]
+                if not tbl.TablePtr(tune):
+                    continue
+                if type(tbl.conditional) is str and not conf.EvalConditional(tune, tbl.conditional):
+                    continue
+                self.nodes.append(TableNode(conf, tune, tbl,
+                                            outputs.get(config.SubstField(m[1]))))
+            elif m[0] == 'page' and [f for f in m[2:] if f[2].endswith('_expr')]:
+                self.nodes.append(MathNode(conf, tune, m, outputs.get(config.SubstField(m[1]))))
+
+    # Kahn's algorithm over node inputs; raises ValueError on a cycle
+    def Sort(self):
+        producer = dict([(n.output, n) for n in self.nodes if n.output])
+        deps = dict([(n, set([producer[v] for v in n.inputs if v in producer]))
+                     for n in self.nodes])
+        users = dict([(n, []) for n in self.nodes])
+        for n, d in deps.items():
+            for p in d:
+                users[p].append(n)
+        ready = [n for n in self.nodes if not deps[n]]
+        order = []
+        while ready:
+            n = ready.pop(0)
+            order.append(n)
+            for u in users[n]:
+                deps[u].discard(n)
+                if not deps[u]:
+                    ready.append(u)
+        if len(order) != len(self.nodes):
+            raise ValueError('dependency cycle involving %s' %
+                             ', '.join([n.name for n in self.nodes if n not in order]))
+        return order
+
+    # inputs maps input variable short_name to an array of samples; missing
+    # inputs read as 0.  Returns the values of every variable plus each
+    # table's output under the table short_name.
+    def Run(self, inputs):
+        shape = numpy.broadcast_shapes(*[numpy.shape(v) for v in inputs.values()])
+        values = {}
+        for v in self.inputs:
+            values[v] = numpy.broadcast_to(numpy.asarray(inputs.get(v, 0), dtype=float), shape)
+        for n in self.order:
+            out = numpy.broadcast_to(numpy.asarray(n.Evaluate(values), dtype=float), shape)
+            if n.output:
+                values[n.output] = out
+            if isinstance(n, TableNode):
+                values[n.name] = out
+        return values
+
+    # Runs over an iterable of input batches, e.g. chunks of a log
+    def Stream(self, batches):
+        for inputs in batches:
+            yield self.Run(inputs)
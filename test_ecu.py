@@ -0,0 +1,93 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+import ecu
+
+import socket
+import threading
+import time
+import unittest
+
+# Stand-in ECU on a local TCP port that answers the first request only
+# after delay seconds
+class SlowServer:
+    def __init__(self, size, delay):
+        self.emulator = ecu.Emulator(size)
+        self.delay = delay
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.Accept, daemon=True).start()
+
+    def Accept(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.Serve, args=(conn,), daemon=True).start()
+
+    def Serve(self, conn):
+        try:
+            while True:
+                frame = RecvExact(conn, ecu.request.size)
+                cmd, seq, offset, length = ecu.request.unpack(frame)
+                if cmd == ecu.WRITE:
+                    frame += RecvExact(conn, length)
+                if self.delay:
+                    delay, self.delay = self.delay, 0
+                    time.sleep(delay)
+                conn.sendall(self.emulator.Handle(frame))
+        except OSError:
+            pass
+        conn.close()
+
+    def Close(self):
+        self.sock.close()
+
+def RecvExact(conn, n):
+    buf = b''
+    while len(buf) < n:
+        chunk = conn.recv(n - len(buf))
+        if not chunk:
+            raise OSError('closed')
+        buf += chunk
+    return buf
+
+class ReconnectTest(unittest.TestCase):
+    def testDelayedReply(self):
+        server = SlowServer(1000, 0.3)
+        self.addCleanup(server.Close)
+        link = ecu.Ecu(lambda: ecu.TcpTransport('127.0.0.1', server.port, timeout=0.1))
+        with self.assertRaises(OSError):
+            link.Write(0, b'late')
+        # The late reply to the first write must not answer the later ones
+        time.sleep(0.4)
+        link.Write(10, b'abc')
+        self.assertEqual(link.Read(10, 3), b'abc')
+        link.Write(0, b'late')
+        self.assertEqual(bytes(server.emulator.image[0:4]), b'late')
+
+    def testConnectsOnFirstUse(self):
+        sock = socket.create_server(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        link = ecu.Open('tcp:127.0.0.1:%d' % port, 1000)
+        with self.assertRaises(OSError):
+            link.ReadRealtime(0, 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+import mathexpr
+
+import unittest
+
+class CompareTest(unittest.TestCase):
+    def testArithmeticOnComparisons(self):
+        f = mathexpr.Compile('(a>b) - (c>d)')
+        self.assertEqual(list(f(a=[0, 2, 5], b=1, c=1, d=0)), [-1, 0, 0])
+
+    def testUnaryMinusOnComparison(self):
+        self.assertEqual(list(mathexpr.Compile('-(a>b)')(a=[0, 2], b=1)), [0, -1])
+
+    def testChainGivesOneOrZero(self):
+        res = mathexpr.Compile('1 < a < 3')(a=[0, 2, 5])
+        self.assertEqual(res.dtype, float)
+        self.assertEqual(list(res), [0, 1, 0])
+
+class CheckTest(unittest.TestCase):
+    def testRejects(self):
+        for text in ('ab + 1', '().__class__', 'f(a)', "'x'", '1/0', '9**9**8'):
+            with self.assertRaises(ValueError, msg=text):
+                mathexpr.Compile(text)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -22,16 +22,29 @@
 
 
 import config
+import ecu
+import ecuasync
+import journal
+import realtime
+import tunefile
+try:
+    import lookup # needs NumPy, only for the live operating point cursor
+except ImportError:
+    lookup = None
 
 import binascii
-import json
+import os
 import re
-import socket
 import struct
-from PyQt5.QtCore import Qt, QEvent, QModelIndex, pyqtSignal
+import sys
+import time
+from PyQt5.QtCore import Qt, QAbstractTableModel, QEvent, QModelIndex, QTimer, pyqtSignal
 
 from PyQt5.QtGui import (
+    QColor,
+    QKeySequence,
     QPainter,
+    QPen,
     QStandardItem,
     QStandardItemModel,
     QValidator,
@@ -47,6 +60,7 @@ from PyQt5.QtWidgets import (
     QGroupBox,
     QHBoxLayout,
     QHeaderView,
+    QInputDialog,
     QLabel,
     QLineEdit,
     QMainWindow,
@@ -55,6 +69,7 @@ from PyQt5.QtWidgets import (
     QPushButton,
     QSizePolicy,
     QSplitter,
+    QTableView,
     QTableWidget,
     QTableWidgetItem,
     QTreeView,
@@ -128,30 +143,207 @@ class VariableButton(QPushButton):
         self.short_name = short_name
         self.extra_vars = extra_vars
         self.clicked.connect(self.chooseVar)
+        parent_panel.watchVarButton(self)
+        self.destroyed.connect(lambda: parent_panel.unwatchVarButton(self, self.short_name))
 
     def chooseVar(self, ev):
         name = self.parent_panel.variableChooser(self.chooser_title, self.short_name,
                                                  self.extra_vars)
         if name != self.short_name:
+            self.parent_panel.unwatchVarButton(self, self.short_name)
             self.short_name = name
+            self.parent_panel.watchVarButton(self)
             self.setText(self.parent_panel.getNiceVariableName(name, self.extra_vars))
             self.varChange.emit(name)
 
+    # Show another variable without emitting varChange, e.g. after an undo
+    def setVariable(self, name):
+        if name != self.short_name:
+            self.parent_panel.unwatchVarButton(self, self.short_name)
+            self.short_name = name
+            self.parent_panel.watchVarButton(self)
+            self.setText(self.parent_panel.getNiceVariableName(name, self.extra_vars))
+
+# Table cells straight from the tune, read only when the view asks for them.
+# Writes to the tune from anywhere (edits, block operations, autotune) are
+# picked up through the tune watchers and reported as dataChanged for the
+# rows they touched; header writes schedule a model reset.
+class TableModel(QAbstractTableModel):
+    def __init__(self, conf, tune, table_name, parent=None):
+        super().__init__(parent)
+        self.tbl = conf.all_tables[table_name]
+        self.tune = tune
+        self.resetPending = False
+        self.closed = False
+        self.Snapshot()
+        tune.watchers.append(self.written)
+
+    def Close(self):
+        self.closed = True
+        if self.written in self.tune.watchers:
+            self.tune.watchers.remove(self.written)
+
+    # Layout used to map tune writes to cells, only refreshed on reset as
+    # the table may be half rewritten while the watchers run
+    def Snapshot(self):
+        layout = self.tbl.Layout(self.tune)
+        self.ptr = layout.ptr
+        self.data_ptr = layout.data_ptr
+        self.bits = layout.bits
+        self.shape = self.tbl.DataShape(self.tune)
+        self.hbins = [FormatNumber(b, self.tbl.AxisExponent(self.tune, 0))
+                      for b in self.tbl.AxisBins(self.tune, 0)]
+        self.vbins = [FormatNumber(b, self.tbl.AxisExponent(self.tune, 1))
+                      for b in self.tbl.AxisBins(self.tune, 1)]
+
+    def Reset(self):
+        if self.closed:
+            return
+        self.beginResetModel()
+        self.Snapshot()
+        self.resetPending = False
+        self.endResetModel()
+
+    def written(self, offset, size):
+        end = offset + size
+        header = (offset < self.tbl.offset + config.ptr_struct.size and end > self.tbl.offset or
+                  offset < self.data_ptr and end > self.ptr)
+        if header:
+            if not self.resetPending:
+                self.resetPending = True
+                QTimer.singleShot(0, self.Reset)
+            return
+        if not self.ptr or end <= self.data_ptr:
+            return
+        h, w = self.shape
+        first = (offset - self.data_ptr) * 8 // self.bits // w
+        last = min(((end - self.data_ptr) * 8 - 1) // self.bits // w, h - 1)
+        if first <= last:
+            self.dataChanged.emit(self.index(first, 0), self.index(last, w - 1))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.shape[0]
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.shape[1]
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return FormatNumber(self.tbl.Data(self.tune, index.row(), index.column()),
+                                self.tbl.exponent)
+        if role == Qt.TextAlignmentRole:
+            return int(Qt.AlignRight | Qt.AlignVCenter)
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        bins = self.hbins if orientation == Qt.Horizontal else self.vbins
+        return bins[section] if section < len(bins) else None
+
+    def flags(self, index):
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole:
+            return False
+        try:
+            value = float(value)
+        except ValueError:
+            return False
+        self.tbl.setData(self.tune, index.row(), index.column(), value)
+        return True
+
+    # Writes a 2-D block of values with its top left cell at (row, col) in
+    # one pass over the table; whatever falls outside the table is dropped
+    def SetBlock(self, row, col, values):
+        data = self.tbl.DataBlock(self.tune)
+        h, w = self.shape
+        for r, vals in enumerate(values[:h - row]):
+            data[row + r][col : col + len(vals)] = vals[:w - col]
+        self.tbl.setDataBlock(self.tune, data)
+
+# Table grid that can mark the engine's current operating point, placed
+# between cell centres by the lookup's fractional position.  Live values
+# only move the cursor; repainting is left to EditPanel's frame timer.
+class TableGrid(QTableView):
+    def __init__(self, conf, tune, table_name):
+        super().__init__()
+        self.conf = conf
+        self.tune = tune
+        self.table_name = table_name
+        self.lookup = None
+        self.cursor = None # fractional (row, column)
+        self.cursorDirty = False
+
+    def setModel(self, model):
+        super().setModel(model)
+        model.modelReset.connect(self.rebuildLookup)
+        self.rebuildLookup()
+
+    def rebuildLookup(self):
+        if lookup:
+            self.lookup = lookup.TableLookup(self.conf, self.tune, self.table_name)
+
+    def setOperatingPoint(self, values):
+        if not self.lookup:
+            return
+        r, c = self.lookup.Position(values.get(self.lookup.xvar, 0),
+                                    values.get(self.lookup.yvar, 0))
+        if (float(r), float(c)) != self.cursor:
+            self.cursor = (float(r), float(c))
+            self.cursorDirty = True
+
+    def clearOperatingPoint(self):
+        if self.cursor:
+            self.cursor = None
+            self.cursorDirty = True
+
+    def centre(self, pos, count, start, size):
+        i = min(int(pos), count - 1)
+        a = start(i) + size(i) / 2
+        if i + 1 >= count:
+            return a
+        return a + (start(i + 1) + size(i + 1) / 2 - a) * (pos - i)
+
+    def paintEvent(self, ev):
+        super().paintEvent(ev)
+        self.cursorDirty = False
+        if not self.cursor or not self.model().rowCount():
+            return
+        y = self.centre(self.cursor[0], self.model().rowCount(),
+                        self.rowViewportPosition, self.rowHeight)
+        x = self.centre(self.cursor[1], self.model().columnCount(),
+                        self.columnViewportPosition, self.columnWidth)
+        painter = QPainter(self.viewport())
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setPen(QPen(QColor(220, 0, 0), 2))
+        painter.drawEllipse(int(x) - 5, int(y) - 5, 10, 10)
+
 class EditPanel(QMainWindow):
-    def __init__(self):
+    storeDone = pyqtSignal(object, object)
+    realtimeDone = pyqtSignal(object)
+
+    # path is a .tune or .json file; without one config.tune is opened, or
+    # the demo in config.json if there is none yet.  Saving always writes
+    # the .tune format, next to a .json input.
+    def __init__(self, path=None):
         super(EditPanel, self).__init__()
 
-        with open('config.json', 'rt') as f:
-            data = json.load(f)
-        self.config = config.Config(data['config'])
-        self.tune = self.config.Encode(data['tune'])
+        if path is None:
+            path = 'config.tune' if os.path.exists('config.tune') else 'config.json'
+        self.config, self.tune = tunefile.LoadAny(path)
+        self.path = os.path.splitext(path)[0]
+        self.journal = journal.Journal(self.config, self.tune)
 
         layout = QHBoxLayout()
         mainSizer = QSplitter(Qt.Horizontal)
 
         self.conditional = {}
         self.conditionalPages = {}
-        self.menutext = []
+        self.menutext = {} # map label to [(setter, widget)] displaying it
+        self.varbuttons = {} # map variable short_name to VariableButtons showing it
+        self.fieldwidgets = {} # map field short_name to [(refresh, widget)] editing it
 
         # XXX disable menu items based on expression
         tree = QTreeWidget()
@@ -175,37 +367,215 @@ class EditPanel(QMainWindow):
         act = QAction('Save', self)
         act.triggered.connect(self.save)
         fileMenu.addAction(act)
+        act = QAction('Export JSON', self)
+        act.triggered.connect(self.exportJson)
+        fileMenu.addAction(act)
+
+        editMenu = menuBar.addMenu('Edit')
+        self.undoAction = QAction('Undo', self)
+        self.undoAction.setShortcut(QKeySequence.Undo)
+        self.undoAction.triggered.connect(self.undo)
+        editMenu.addAction(self.undoAction)
+        self.redoAction = QAction('Redo', self)
+        self.redoAction.setShortcut(QKeySequence.Redo)
+        self.redoAction.triggered.connect(self.redo)
+        editMenu.addAction(self.redoAction)
+        editMenu.aboutToShow.connect(self.updateEditMenu)
+
+        spec = os.environ.get('TUNEDEMO_ECU', 'emulator')
+        if spec.startswith('async:'):
+            host, _, port = spec[6:].rpartition(':')
+            self.ecuLink = ecuasync.ThreadedLink(host, int(port))
+        else:
+            self.ecuLink = ecu.Open(spec, self.config.total_size)
+        self.ecuStore = ecu.TuneStore(self.tune, self.ecuLink)
+        self.storeDone.connect(self.storeFinished)
+
+        # Live data: polled at TUNEDEMO_RATE Hz, the cursors on the table
+        # grids are repainted at most once per frame
+        self.poller = realtime.Poller(self.config, int(os.environ.get('TUNEDEMO_RATE', 50)))
+        self.sweep = None
+        if spec == 'emulator':
+            self.sweep = realtime.Sweep(self.config, self.ecuLink.transport.emulator)
+        self.pollPending = False
+        self.pollTimer = QTimer(self)
+        self.pollTimer.setInterval(int(1000 * self.poller.Interval()))
+        self.pollTimer.timeout.connect(self.poll)
+        self.realtimeDone.connect(self.realtimeFinished)
+        self.grids = [] # TableGrids showing the operating point
+        self.frameTimer = QTimer(self)
+        self.frameTimer.setInterval(33)
+        self.frameTimer.timeout.connect(self.repaintCursors)
 
         ecuMenu = menuBar.addMenu('ECU')
-        ecuMenu.addAction(QAction('Store', self))
+        act = QAction('Store', self)
+        act.triggered.connect(self.store)
+        ecuMenu.addAction(act)
+        self.liveAction = QAction('Live Data', self)
+        self.liveAction.setCheckable(True)
+        self.liveAction.toggled.connect(self.setLive)
+        ecuMenu.addAction(self.liveAction)
+
+    def updateEditMenu(self):
+        label = self.journal.UndoLabel()
+        self.undoAction.setText('Undo ' + label if label else 'Undo')
+        self.undoAction.setEnabled(self.journal.CanUndo())
+        label = self.journal.RedoLabel()
+        self.redoAction.setText('Redo ' + label if label else 'Redo')
+        self.redoAction.setEnabled(self.journal.CanRedo())
+
+    def undo(self):
+        label = self.journal.UndoLabel()
+        ranges = self.journal.Undo()
+        if ranges:
+            self.refreshFields(ranges)
+            self.statusBar().showMessage('Undid ' + label)
+
+    def redo(self):
+        label = self.journal.RedoLabel()
+        ranges = self.journal.Redo()
+        if ranges:
+            self.refreshFields(ranges)
+            self.statusBar().showMessage('Redid ' + label)
+
+    # Brings everything showing a field in the (offset, size) ranges up to
+    # date after the tune was changed behind the widgets' backs.  Table grids
+    # follow the tune themselves, but not their axis labels and link settings.
+    def refreshFields(self, ranges):
+        names = set()
+        for o, size in ranges:
+            names.update([f.short_name for f in self.config.FieldsIn(o, o + size)])
+        for t in self.config.all_tables.values():
+            layout = t.Layout(self.tune)
+            if [1 for o, size in ranges if o < layout.data_ptr and layout.ptr < o + size]:
+                names.add(t.short_name)
+        for f in self.config.all_fields.values():
+            if f.short_name not in names:
+                continue
+            self.updateConditional(f.short_name)
+            self.updateMenuText(f.short_name)
+            for refresh, widget in self.fieldwidgets.get(f.short_name, []):
+                refresh()
+
+    # Call refresh() when fld is changed by undo or redo, until widget is
+    # destroyed
+    def watchField(self, fld, refresh, widget):
+        entry = (refresh, widget)
+        self.fieldwidgets.setdefault(fld, []).append(entry)
+        widget.destroyed.connect(lambda: self.fieldwidgets[fld].remove(entry))
 
     def save(self):
-        data = self.config.Decode(self.tune)
-        with open('config.json', 'wt') as f:
-            json.dump(data, f, indent=2)
+        tunefile.Save(self.path + '.tune', self.config, self.tune)
+
+    def exportJson(self):
+        tunefile.ExportJson(self.path + '.json', self.config, self.tune)
+
+    def store(self):
+        if isinstance(self.ecuLink, ecuasync.ThreadedLink):
+            blocks = self.ecuStore.Take()
+            self.statusBar().showMessage('Storing...')
+            self.ecuLink.Store(blocks).add_done_callback(
+                lambda fut: self.storeDone.emit(fut, blocks))
+            return
+        try:
+            sent = self.ecuStore.Store()
+        except (OSError, ecu.EcuError) as e:
+            self.statusBar().showMessage('Store failed: %s' % self.storeError(e))
+            return
+        self.statusBar().showMessage('Stored %d bytes' % sent)
+
+    # Names the field a failed tune write was for
+    def storeError(self, e):
+        f = None
+        if getattr(e, 'offset', None) is not None:
+            f = self.config.FieldAt(e.offset, self.tune)
+        return '%s (%s)' % (e, f.name) if f else str(e)
+
+    # Runs on the GUI thread once an asynchronous store completes
+    def storeFinished(self, fut, blocks):
+        if fut.exception():
+            self.ecuStore.Failed(blocks)
+            self.statusBar().showMessage('Store failed: %s' % self.storeError(fut.exception()))
+        else:
+            self.statusBar().showMessage('Stored %d bytes' %
+                                         sum([len(data) for b, data in blocks]))
 
-    def updateConditional(self):
-        for v in self.conditional.values():
+    def setLive(self, on):
+        if on:
+            self.pollTimer.start()
+            self.frameTimer.start()
+            return
+        self.pollTimer.stop()
+        self.frameTimer.stop()
+        for grid in self.grids:
+            grid.clearOperatingPoint()
+        self.repaintCursors()
+
+    def poll(self):
+        if self.sweep:
+            self.sweep.Update(time.monotonic())
+        if isinstance(self.ecuLink, ecuasync.ThreadedLink):
+            # Skip polls while one is still in flight rather than queue them
+            if not self.pollPending:
+                self.pollPending = True
+                fut = self.ecuLink.ReadRealtime(0, self.poller.decoder.size)
+                fut.add_done_callback(self.realtimeDone.emit)
+            return
+        try:
+            self.poller.Poll(self.ecuLink)
+        except (OSError, ecu.EcuError) as e:
+            self.liveAction.setChecked(False)
+            self.statusBar().showMessage('Live data failed: %s' % e)
+
+    # Runs on the GUI thread once an asynchronous realtime read completes
+    def realtimeFinished(self, fut):
+        self.pollPending = False
+        if fut.exception():
+            self.liveAction.setChecked(False)
+            self.statusBar().showMessage('Live data failed: %s' % fut.exception())
+        elif self.pollTimer.isActive():
+            self.poller.Publish(fut.result())
+
+    def repaintCursors(self):
+        for grid in self.grids:
+            if grid.cursorDirty:
+                grid.viewport().update()
+
+    def watchGrid(self, grid):
+        self.grids.append(grid)
+        self.poller.Subscribe(grid.setOperatingPoint)
+        grid.destroyed.connect(lambda: (self.grids.remove(grid),
+                                        self.poller.Unsubscribe(grid.setOperatingPoint)))
+
+    # Only the conditionals that reference fld need to be evaluated again
+    def updateConditional(self, fld):
+        changed = set()
+        for n in self.config.Dependents(fld).conditionals:
+            v = self.conditional.get(n)
+            if not v:
+                continue
             en = self.config.EvalConditional(self.tune, v[0])
             if en != v[1]:
                 v[1] = en
+                changed.add(n)
                 if v[2]:
                     v[2].setDisabled(not en)
+        if not changed:
+            return
         for v in self.conditionalPages.values():
             for n, w in v:
-                w.setDisabled(not self.conditional[n][1])
+                if n in changed:
+                    w.setDisabled(not self.conditional[n][1])
 
     def buildTree(self, root, menus):
         for m in menus:
             if m[0] == 'submenu':
                 item = QTreeWidgetItem(root, [self.getTextSubst(m[1])])
-                if '$' in m[1]:
-                    self.menutext.append((m[1], item))
+                self.watchText(m[1], lambda txt, item=item: item.setText(0, txt))
                 self.buildTree(item, m[2:])
             elif m[0] =='page' or m[0] == 'table':
                 item = QTreeWidgetItem(root, [self.getTextSubst(m[1])])
-                if '$' in m[1]:
-                    self.menutext.append((m[1], item))
+                self.watchText(m[1], lambda txt, item=item: item.setText(0, txt))
                 item.setData(1, Qt.EditRole, m)
                 if m[0] == 'page':
                     for f in m[2:]:
@@ -230,7 +600,9 @@ class EditPanel(QMainWindow):
             # Bring to foreground
             return
         dia = QMdiSubWindow()
+        dia.setAttribute(Qt.WA_DeleteOnClose)
         dia.setWindowTitle(name)
+        self.watchText(newpanel[1], dia.setWindowTitle, dia)
         self.conditionalPages[newpanel[1]] = []
         panel = WidgetTrapClose(self, newpanel[1])
         dia.setWidget(panel)
@@ -240,24 +612,47 @@ class EditPanel(QMainWindow):
 
     def setField(self, txt, fld):
         print("Setting %s to %s" % (fld, txt))
-        self.config.all_fields[fld].set(self.tune, self.config, txt)
-        self.updateConditional()
+        with self.journal.Group('Set ' + self.getTextSubst(self.config.all_fields[fld].name)):
+            self.config.all_fields[fld].set(self.tune, self.config, txt)
+        self.updateConditional(fld)
         self.updateMenuText(fld)
 
     def setFieldLineEdit(self, widget, field, conv):
         self.setField(conv(widget.text()), field)
 
+    # Refresh only the labels and variable names that substitute fld
     def updateMenuText(self, fld):
-        for txt, item in self.menutext:
-            if txt.endswith('$' + fld):
-                item.setText(0, self.getTextSubst(txt))
+        deps = self.config.Dependents(fld)
+        for txt in deps.labels:
+            for setter, widget in self.menutext.get(txt, []):
+                setter(self.getTextSubst(txt))
+        for v in deps.variables:
+            for button in self.varbuttons.get(v, []):
+                button.setText(self.getNiceVariableName(v, button.extra_vars))
+
+    # Keep setter(text) up to date with txt, until widget is destroyed
+    def watchText(self, txt, setter, widget=None):
+        if not config.SubstField(txt):
+            return
+        entry = (setter, widget)
+        self.menutext.setdefault(txt, []).append(entry)
+        if widget:
+            widget.destroyed.connect(lambda: self.menutext[txt].remove(entry))
+
+    def watchVarButton(self, button):
+        self.varbuttons.setdefault(button.short_name, []).append(button)
+
+    def unwatchVarButton(self, button, short_name):
+        if button in self.varbuttons.get(short_name, []):
+            self.varbuttons[short_name].remove(button)
 
     def getTextSubst(self, txt):
         v = txt.split('$')
-        if len(v) > 1 and self.config.all_fields[v[1]].get(self.tune) != '':
-            return v[0] + ' - ' + self.config.all_fields[v[1]].get(self.tune)
-        else:
-            return v[0]
+        if len(v) > 1:
+            val = self.config.all_fields[v[1]].get(self.tune)
+            if val != '':
+                return v[0] + ' - ' + val
+        return v[0]
 
     def addVarsToTree(self, tree, vars, search):
         ret = None
@@ -293,6 +688,9 @@ class EditPanel(QMainWindow):
                     edit.addItems(f[4])
                     edit.setCurrentText(self.config.all_fields[f[2]].get(self.tune))
                     edit.currentTextChanged.connect(closure(self.setField, f[2]))
+                    self.watchField(f[2], lambda edit=edit, fld=self.config.all_fields[f[2]]: (
+                        edit.blockSignals(True), edit.setCurrentText(fld.get(self.tune)),
+                        edit.blockSignals(False)), edit)
                     gridsizer.addWidget(edit, row, 1, 1, 1)
                 elif f[0] == 'scalar' or f[0] == 'text':
                     edit = QLineEdit()
@@ -302,15 +700,22 @@ class EditPanel(QMainWindow):
                         edit.setValidator(ScalarValidator(self.config.all_fields[f[2]].exponent))
                         edit.editingFinished.connect(closure(self.setFieldLineEdit,
                                                              edit, f[2], float))
+                        self.watchField(f[2], lambda edit=edit, fld=self.config.all_fields[f[2]]:
+                                        edit.setText(FormatNumber(fld.get(self.tune),
+                                                                  fld.exponent)), edit)
                     else:
                         edit.setText(self.config.all_fields[f[2]].get(self.tune))
                         edit.editingFinished.connect(closure(self.setFieldLineEdit,
                                                              edit, f[2], str))
+                        self.watchField(f[2], lambda edit=edit, fld=self.config.all_fields[f[2]]:
+                                        edit.setText(fld.get(self.tune)), edit)
                     gridsizer.addWidget(edit, row, 1, 1, 1)
                 elif f[0] == 'varselect':
                     edit = VariableButton(self, 'Variable for ' + f[1],
                                           self.config.all_fields[f[2]].get(self.tune, self.config))
                     edit.varChange.connect(closure(self.setField, f[2]))
+                    self.watchField(f[2], lambda edit=edit, fld=self.config.all_fields[f[2]]:
+                                    edit.setVariable(fld.get(self.tune, self.config)), edit)
                     gridsizer.addWidget(edit, row, 1, 1, 1)
                 else:
                     print("Unknown field type", f[0])
@@ -324,25 +729,47 @@ class EditPanel(QMainWindow):
         elif newpanel[0] == 'table':
             tbl = self.config.all_tables[newpanel[2]]
             if tbl.TablePtr(self.tune) == 0:
-                tbl.setTablePtr(self.tune, self.config.AllocateTable(self.tune, newpanel[2],
-                                                                     0, None, [], 0, None, []))
+                with self.journal.Group('Create ' + self.getTextSubst(tbl.name)):
+                    tbl.setTablePtr(self.tune,
+                                    self.config.AllocateTable(self.tune, newpanel[2],
+                                                              0, None, [], 0, None, []))
             gridsizer = QGridLayout()
             gridpanel.setLayout(gridsizer)
 
-            gridsizer.addWidget(QLabel(self.getTextSubst(newpanel[1])), 0, 1) # XXX dynamic update
+            title = QLabel(self.getTextSubst(newpanel[1]))
+            self.watchText(newpanel[1], title.setText, title)
+            gridsizer.addWidget(title, 0, 1)
             hunits = QLabel('')
             vunits = VerticalLabel('')
             vunits.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Minimum)
             gridsizer.addWidget(hunits, 0, 2)
             gridsizer.addWidget(vunits, 1, 0)
 
-            grid = QTableWidget(0, 0)
+            grid = TableGrid(self.config, self.tune, newpanel[2])
+            model = TableModel(self.config, self.tune, newpanel[2], grid)
+            grid.setModel(model)
+            grid.destroyed.connect(lambda: model.Close())
+            self.watchGrid(grid)
             self.UpdateGrid(tbl, grid, hunits, vunits)
             grid.setContextMenuPolicy(Qt.ActionsContextMenu)
             axisAction = QAction("Axis", grid)
             axisAction.triggered.connect(closure(self.setAxis, grid, newpanel[2], hunits, vunits))
             grid.addAction(axisAction)
-            grid.cellChanged.connect(closure(self.updateCell, grid, newpanel[2]))
+            for label, op, prompt in (('Scale...', tbl.ScaleCells, 'Percent change'),
+                                      ('Offset...', tbl.OffsetCells, 'Add to cells'),
+                                      ('Set Value...', tbl.SetCells, 'New value'),
+                                      ('Interpolate', tbl.InterpolateCells, None),
+                                      ('Smooth', tbl.SmoothCells, None)):
+                act = QAction(label, grid)
+                act.triggered.connect(closure(self.cellOperation, grid, tbl, op, prompt))
+                grid.addAction(act)
+            for label, func, key in (('Copy', self.copyCells, QKeySequence.Copy),
+                                     ('Paste', self.pasteCells, QKeySequence.Paste)):
+                act = QAction(label, grid)
+                act.setShortcut(key)
+                act.setShortcutContext(Qt.WidgetShortcut)
+                act.triggered.connect(closure(func, grid))
+                grid.addAction(act)
             gridsizer.addWidget(grid, 1, 1, 1, 2)
 
             buttonWidget = QWidget()
@@ -377,10 +804,66 @@ class EditPanel(QMainWindow):
             tableCombo.setCurrentIndex(tbl.Interpolate(self.tune))
             tableCombo.currentTextChanged.emit(tableCombo.currentText())
 
-
-    def updateCell(self, row, col, grid, table_name):
-        self.config.all_tables[table_name].setData(self.tune, row, col,
-                                                   float(grid.item(row, col).text()))
+            def refresh():
+                self.UpdateGrid(tbl, grid, hunits, vunits)
+                tableCombo.blockSignals(True)
+                tableCombo.setCurrentIndex(tbl.Interpolate(self.tune))
+                tableCombo.blockSignals(False)
+                txt = tableCombo.currentText()
+                valueB.setVariable(tbl.InterpolateVar(self.tune, self.config, 0))
+                valueB.setDisabled('B' not in txt.split(':')[1])
+                valueC.setVariable(tbl.InterpolateVar(self.tune, self.config, 1))
+                valueC.setDisabled('C' not in txt.split(':')[1])
+            self.watchField(tbl.short_name, refresh, grid)
+
+    # Runs a Table block operation on the bounding rectangle of the grid
+    # selection, asking for its argument first if it takes one
+    def cellOperation(self, ev, grid, tbl, op, prompt):
+        cells = grid.selectionModel().selectedIndexes()
+        if not cells:
+            return
+        rows = [i.row() for i in cells]
+        cols = [i.column() for i in cells]
+        sel = (min(rows), min(cols), max(rows), max(cols))
+        if prompt is None:
+            with self.journal.Group('Edit cells'):
+                op(self.tune, sel)
+            return
+        lo, hi = tbl.CellRange()
+        val, ok = QInputDialog.getDouble(self, self.getTextSubst(tbl.name), prompt, 0,
+                                         -2 * (hi - lo), 2 * (hi - lo), max(-tbl.exponent, 0))
+        if ok:
+            with self.journal.Group('Edit cells'):
+                op(self.tune, sel, val)
+
+    # Copies the bounding rectangle of the grid selection as tab separated
+    # rows, the way spreadsheets exchange cells
+    def copyCells(self, ev, grid):
+        cells = grid.selectionModel().selectedIndexes()
+        if not cells:
+            return
+        model = grid.model()
+        rows = [i.row() for i in cells]
+        cols = [i.column() for i in cells]
+        QApplication.clipboard().setText('\n'.join(
+            ['\t'.join([model.data(model.index(r, c)) for c in range(min(cols), max(cols) + 1)])
+             for r in range(min(rows), max(rows) + 1)]) + '\n')
+
+    # Pastes tab separated rows from the clipboard with their top left cell
+    # at the top left of the selection, as one undoable edit
+    def pasteCells(self, ev, grid):
+        cells = grid.selectionModel().selectedIndexes() or [grid.currentIndex()]
+        if not cells[0].isValid():
+            return
+        try:
+            values = [[float(v) for v in line.split('\t')]
+                      for line in QApplication.clipboard().text().strip('\n').split('\n')]
+        except ValueError:
+            self.statusBar().showMessage('Paste failed: clipboard does not hold numbers')
+            return
+        with self.journal.Group('Paste'):
+            grid.model().SetBlock(min([i.row() for i in cells]),
+                                  min([i.column() for i in cells]), values)
 
     # extra_vars is a list of tuple(name, short_name)
     def variableChooser(self, title, current, extra_vars):
@@ -494,10 +977,6 @@ class EditPanel(QMainWindow):
         buttons.rejected.connect(dia.reject)
 
         if dia.exec_():
-            interpolate = (tbl.Interpolate(self.tune),
-                           tbl.InterpolateVar(self.tune, self.config, 0),
-                           tbl.InterpolateVar(self.tune, self.config, 1))
-
             xitems = [xbins.item(0, c) for c in range(24)]
             xitems = [i.text() for i in xitems if i]
             xitems = [float(i) for i in xitems if i]
@@ -508,61 +987,43 @@ class EditPanel(QMainWindow):
             yitems = [float(i) for i in yitems if i]
             yitems.sort()
 
-            tbl_ptr = self.config.AllocateTable(
-                self.tune, table_name,
-                0, xaxis.short_name, xitems if xaxis.short_name else [],
-                0, yaxis.short_name, yitems if yaxis.short_name else [])
+            with self.journal.Group('Change axis'):
+                ptr = self.config.ResizeTable(
+                    self.tune, table_name,
+                    0, xaxis.short_name, xitems if xaxis.short_name else [],
+                    0, yaxis.short_name, yitems if yaxis.short_name else [])
+            if ptr is None:
+                self.statusBar().showMessage('Change axis failed: not enough table space')
+                return
 
             # XXX PRESERVE OLD DATA, INTERPOLATE?
 
-            tbl.setTablePtr(self.tune, tbl_ptr)
-
-            tbl.SetInterpolate(self.tune, interpolate[0])
-            tbl.SetInterpolateVar(self.tune, self.config, 0, interpolate[1])
-            tbl.SetInterpolateVar(self.tune, self.config, 1, interpolate[2])
-
             self.UpdateGrid(tbl, grid, hunits, vunits)
 
     def UpdateGrid(self, tbl, grid, hunits, vunits):
-        hbins = tbl.AxisBins(self.tune, 0)
-        w = len(hbins) or 1
-        grid.setColumnCount(w)
-        if hbins:
-            grid.setHorizontalHeaderLabels([FormatNumber(b, tbl.AxisExponent(self.tune, 0))
-                                            for b in hbins])
-            grid.horizontalHeader().show()
-        else:
-            grid.horizontalHeader().hide()
-
-        vbins = tbl.AxisBins(self.tune, 1)
-        h = len(vbins) or 1
-        grid.setRowCount(h)
-        if vbins:
-            grid.setVerticalHeaderLabels([FormatNumber(b, tbl.AxisExponent(self.tune, 1))
-                                          for b in vbins])
-            grid.verticalHeader().show()
-        else:
-            grid.verticalHeader().hide()
-
-        grid.resizeColumnsToContents()
-        grid.resizeRowsToContents()
+        grid.model().Reset()
+        grid.horizontalHeader().setVisible(bool(tbl.AxisBins(self.tune, 0)))
+        grid.verticalHeader().setVisible(bool(tbl.AxisBins(self.tune, 1)))
+        # Size the columns for the widest value the cells can hold instead
+        # of measuring every cell
+        grid.horizontalHeader().setDefaultSectionSize(
+            max([grid.fontMetrics().width(FormatNumber(v, tbl.exponent))
+                 for v in tbl.CellRange()] +
+                [grid.fontMetrics().width(b) for b in grid.model().hbins]) + 12)
+        grid.verticalHeader().setDefaultSectionSize(grid.fontMetrics().height() + 6)
 
         hunits.setText(self.getNiceVariableName(tbl.AxisShortName(self.config, self.tune, 0),
                                                 [('', None)]))
         vunits.setText(self.getNiceVariableName(tbl.AxisShortName(self.config, self.tune, 1),
                                                 [('', None)]))
 
-        for i in range(h):
-            for j in range(w):
-                grid.setItem(i, j, QTableWidgetItem(FormatNumber(tbl.Data(self.tune, i, j),
-                                                                 tbl.exponent)))
-
 
 
 def main():
     app = QApplication([])  # Create a new app, don't redirect stdout/stderr to a window.
-    panel = EditPanel()
+    panel = EditPanel(sys.argv[1] if len(sys.argv) > 1 else None)
     panel.show()
     app.exec_()
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Comparing and merging tunes of the same configuration without decoding
+# them.  The fixed area is compared by chunk hashes, and only the fields
+# under changed bytes are looked at.  Tables are placed independently in
+# each tune, so they are compared block against block: identical blocks
+# are skipped, otherwise the header settings and the individual cells are
+# compared.
+
+import config
+
+import hashlib
+
+chunk_size = 64
+
+def ChunkHash(data):
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+# Chunk hashes of a tune's fixed area, worth keeping for a base tune that
+# many others are compared against
+class Signature:
+    def __init__(self, conf, tune):
+        view = memoryview(tune)
+        self.hashes = [ChunkHash(view[o : min(o + chunk_size, conf.table_offset)])
+                       for o in range(0, conf.table_offset, chunk_size)]
+
+# Table settings, everything but the cells; None if not allocated
+def Header(tbl, conf, tune):
+    if not tbl.TablePtr(tune):
+        return None
+    return {
+        'interpolate': tbl.Interpolate(tune),
+        'interpolate-B': tbl.InterpolateVar(tune, conf, 0),
+        'interpolate-C': tbl.InterpolateVar(tune, conf, 1),
+        'x-axis': tbl.decode_axis(tune, conf, 0),
+        'y-axis': tbl.decode_axis(tune, conf, 1),
+        }
+
+# Whether the cells of two headers don't line up
+def Reshaped(old, new):
+    return (old is None or new is None or
+            (old['x-axis'], old['y-axis']) != (new['x-axis'], new['y-axis']))
+
+class Diff:
+    def __init__(self):
+        self.fields = {} # map field short_name to (old, new)
+        self.tables = {} # map table short_name to (old Header, new Header)
+        self.cells = {} # map table short_name to [(row, col, old, new)]
+
+    def __bool__(self):
+        return bool(self.fields or self.tables or self.cells)
+
+    # Short names of everything that differs
+    def Names(self):
+        return sorted(set(self.fields) | set(self.tables) | set(self.cells))
+
+# Differences from old to new; old_sig may be a Signature of old to save
+# hashing it again
+def Compare(conf, old, new, old_sig=None):
+    diff = Diff()
+    old_sig = old_sig or Signature(conf, old)
+    new_sig = Signature(conf, new)
+    names = []
+    for i, (a, b) in enumerate(zip(old_sig.hashes, new_sig.hashes)):
+        if a == b:
+            continue
+        base = i * chunk_size
+        end = min(base + chunk_size, conf.table_offset)
+        for lo, hi in config.ChangedRanges(old[base:end], new[base:end]):
+            names += [f.short_name for f in conf.FieldsIn(base + lo, base + hi)
+                      if f.short_name not in names]
+    for n in names:
+        f = conf.all_fields[n]
+        if not isinstance(f, config.Table):
+            diff.fields[n] = (f.decode(old, conf), f.decode(new, conf))
+    for tbl in conf.all_tables.values():
+        CompareTable(conf, tbl, old, new, diff)
+    return diff
+
+def TableBytes(tbl, tune):
+    ptr = tbl.TablePtr(tune)
+    return tune[ptr : ptr + tbl.TableLen(tune)] if ptr else b''
+
+def CompareTable(conf, tbl, old, new, diff):
+    if TableBytes(tbl, old) == TableBytes(tbl, new):
+        return
+    name = tbl.short_name
+    a, b = Header(tbl, conf, old), Header(tbl, conf, new)
+    if a != b:
+        diff.tables[name] = (a, b)
+    if Reshaped(a, b):
+        return
+    olddata, newdata = tbl.DataBlock(old), tbl.DataBlock(new)
+    cells = [(r, c, olddata[r][c], newdata[r][c])
+             for r in range(len(newdata)) for c in range(len(newdata[r]))
+             if olddata[r][c] != newdata[r][c]]
+    if cells:
+        diff.cells[name] = cells
+
+# Three-way merge of the changes from base to theirs into ours.  Returns the
+# merged tune and the conflicts, where both sides changed the same thing
+# differently, as (short_name, cell, base, ours, theirs); cell is None for
+# fields and table settings.  Conflicts keep our value.
+def Merge(conf, base, ours, theirs):
+    sig = Signature(conf, base)
+    mine = Compare(conf, base, ours, sig)
+    other = Compare(conf, base, theirs, sig)
+    merged = config.Tune(ours)
+    conflicts = []
+
+    for n, (old, new) in other.fields.items():
+        if n not in mine.fields:
+            conf.all_fields[n].encode(merged, conf, new)
+        elif mine.fields[n][1] != new:
+            conflicts.append((n, None, old, mine.fields[n][1], new))
+
+    for n in set(other.tables) | set(other.cells):
+        tbl = conf.all_tables[n]
+        if n not in mine.tables and n not in mine.cells:
+            theirs_val = tbl.decode(theirs, conf)
+            if theirs_val is None:
+                conf.FreeTable(merged, n)
+            else:
+                tbl.encode(merged, conf, theirs_val)
+            continue
+        base_hdr, their_hdr = other.tables.get(n, (None, None))
+        our_hdr = mine.tables[n][1] if n in mine.tables else None
+        if n in other.tables and Reshaped(base_hdr, their_hdr) or \
+           n in mine.tables and Reshaped(mine.tables[n][0], our_hdr):
+            # Someone changed the axes, the cells can only be taken whole
+            if tbl.decode(ours, conf) != tbl.decode(theirs, conf):
+                conflicts.append((n, None, Header(tbl, conf, base), Header(tbl, conf, ours),
+                                  Header(tbl, conf, theirs)))
+            continue
+        if n in other.tables:
+            if n not in mine.tables:
+                SetHeader(tbl, conf, merged, their_hdr)
+            elif our_hdr != their_hdr:
+                conflicts.append((n, None, base_hdr, our_hdr, their_hdr))
+        ours_cells = dict([((r, c), v) for r, c, o, v in mine.cells.get(n, [])])
+        block = tbl.DataBlock(merged)
+        for r, c, old, new in other.cells.get(n, []):
+            if (r, c) not in ours_cells:
+                block[r][c] = new
+            elif ours_cells[(r, c)] != new:
+                conflicts.append((n, (r, c), old, ours_cells[(r, c)], new))
+        tbl.setDataBlock(merged, block)
+    return merged, conflicts
+
+# Table link settings from a Header with the same axes
+def SetHeader(tbl, conf, tune, header):
+    tbl.SetInterpolate(tune, header['interpolate'])
+    tbl.SetInterpolateVar(tune, conf, 0, header['interpolate-B'])
+    tbl.SetInterpolateVar(tune, conf, 1, header['interpolate-C'])
@@ -0,0 +1,99 @@
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Binary tune container: a fixed header, the configuration schema as
+# compact JSON (or only its hash), then the tune image verbatim.  Loading
+# doesn't have to decode and re-encode every field like the JSON format.
+
+import config
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+magic = b'TDTN'
+version = 1
+header = struct.Struct('<4sHHI32sI') # magic, version, flags, schema len, schema hash, tune len
+FLAG_EMBEDDED = 1
+
+def SchemaBytes(conf):
+    return json.dumps(conf.conf, sort_keys=True, separators=(',', ':')).encode()
+
+def SchemaHash(conf):
+    return hashlib.sha256(SchemaBytes(conf)).digest()
+
+def IsTuneFile(path):
+    with open(path, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+# Without embed only the schema hash is stored, and Load needs the schema
+# passed in through schemas
+def Save(path, conf, tune, embed=True):
+    schema = SchemaBytes(conf) if embed else b''
+    data = b''.join([header.pack(magic, version, FLAG_EMBEDDED if embed else 0,
+                                 len(schema), hashlib.sha256(SchemaBytes(conf)).digest(),
+                                 len(tune)),
+                     schema,
+                     tune])
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+# schemas maps schema hash to a Config for files saved without embed.
+# Returns (Config, tune)
+def Load(path, schemas={}):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < header.size:
+            raise ValueError('%s: truncated tune file' % path)
+        tag, ver, flags, schema_len, digest, tune_len = header.unpack_from(mm, 0)
+        if tag != magic or ver != version:
+            raise ValueError('%s: not a version %d tune file' % (path, version))
+        if len(mm) != header.size + schema_len + tune_len:
+            raise ValueError('%s: truncated tune file' % path)
+        if flags & FLAG_EMBEDDED:
+            schema = mm[header.size : header.size + schema_len]
+            if hashlib.sha256(schema).digest() != digest:
+                raise ValueError('%s: schema checksum mismatch' % path)
+            conf = config.Config(json.loads(schema))
+        elif digest in schemas:
+            conf = schemas[digest]
+        else:
+            raise ValueError('%s: unknown schema %s' % (path, digest.hex()))
+        if tune_len != conf.total_size:
+            raise ValueError('%s: tune is %d bytes, expected %d' %
+                             (path, tune_len, conf.total_size))
+        tune = config.Tune(mm[header.size + schema_len :])
+    return conf, tune
+
+def ExportJson(path, conf, tune):
+    with open(path, 'wt') as f:
+        json.dump(conf.Decode(tune), f, indent=2)
+
+def ImportJson(path):
+    with open(path, 'rt') as f:
+        data = json.load(f)
+    conf = config.Config(data['config'])
+    return conf, conf.Encode(data['tune'])
+
+# Either format, returns (Config, tune)
+def LoadAny(path, schemas={}):
+    if IsTuneFile(path):
+        return Load(path, schemas)
+    return ImportJson(path)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+# Copyright 2021 Scott Smith
+#
+# This file is part of TuneDemo.
+#
+# TuneDemo is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# TuneDemo is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with TuneDemo.  If not, see <https://www.gnu.org/licenses/>.
+
+# Batch operations on tune files without the GUI (and without Qt):
+#
+#   ./tunetool.py convert --to json|tune [--out DIR] FILE...
+#   ./tunetool.py validate FILE...
+#   ./tunetool.py reencode FILE...      rewrite as a freshly encoded .tune
+#   ./tunetool.py diff BASE FILE...     fields and tables that differ from BASE
+#
+# Files are handled by a pool of worker processes and each result is
+# printed as soon as it is ready, one line per file (--json for JSON
+# lines).  The exit status is 1 if any file failed.
+
+import config
+import tunediff
+import tunefile
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+
+def Convert(path, opts):
+    conf, tune = tunefile.LoadAny(path)
+    base = os.path.splitext(os.path.basename(path))[0] + '.' + opts['to']
+    out = os.path.join(opts['out'] or os.path.dirname(path), base)
+    if os.path.abspath(out) == os.path.abspath(path):
+        raise ValueError('would overwrite the input')
+    if opts['to'] == 'json':
+        tunefile.ExportJson(out, conf, tune)
+    else:
+        tunefile.Save(out, conf, tune)
+    return {'output': out}
+
+# Things the editor would trip over, beyond what loading already checks
+def Problems(conf, tune):
+    problems = []
+    for f in conf.all_fields.values():
+        if isinstance(f, config.Select):
+            if tune[f.offset] >= len(f.choices):
+                problems.append('%s: choice %d out of range' % (f.short_name, tune[f.offset]))
+        elif isinstance(f, config.VarSelect):
+            if tune[f.offset] >= len(conf.variables):
+                problems.append('%s: variable %d out of range' % (f.short_name, tune[f.offset]))
+    end = conf.table_offset
+    for t in sorted([t for t in conf.all_tables.values() if t.TablePtr(tune)],
+                    key=lambda t: t.TablePtr(tune)):
+        ptr = t.TablePtr(tune)
+        if ptr < end:
+            problems.append('%s: table at %d overlaps %s' %
+                            (t.short_name, ptr, 'the fixed area' if end == conf.table_offset
+                             else 'the previous table'))
+        if ptr + t.TableLen(tune) > conf.total_size:
+            problems.append('%s: table at %d runs past the end of the tune' % (t.short_name, ptr))
+            continue
+        for axis in range(2):
+            if t.AxisNBins(tune, axis) and t.AxisShortName(conf, tune, axis) is None:
+                problems.append('%s: axis %d has bins but no variable' % (t.short_name, axis))
+        end = max(end, ptr + t.TableLen(tune))
+    if problems:
+        return problems
+    # Whatever decodes must encode to the same thing again
+    data = conf.Decode(tune)['tune']
+    again = conf.Decode(conf.Encode(data))['tune']
+    problems += ['%s: does not survive re-encoding' % n for n in data if data[n] != again[n]]
+    return problems
+
+def Validate(path, opts):
+    conf, tune = tunefile.LoadAny(path)
+    problems = Problems(conf, tune)
+    if problems:
+        raise ValueError('; '.join(problems))
+    return {}
+
+# Re-encoding drops stale bytes and packs the tables at the start of the
+# table area
+def Reencode(path, opts):
+    conf, tune = tunefile.LoadAny(path)
+    new = conf.Encode(conf.Decode(tune)['tune'])
+    out = os.path.splitext(path)[0] + '.tune'
+    tunefile.Save(out, conf, new)
+    return {'output': out,
+            'changed': sum([e - b for b, e in config.ChangedRanges(tune, new)])}
+
+def Diff(path, opts):
+    base = tunefile.LoadAny(opts['base'])
+    conf, tune = tunefile.LoadAny(path)
+    if tunefile.SchemaHash(conf) != tunefile.SchemaHash(base[0]):
+        raise ValueError('different configuration than %s' % opts['base'])
+    diff = tunediff.Compare(conf, base[1], tune)
+    return {'fields': diff.Names(),
+            'cells': dict([(n, len(c)) for n, c in diff.cells.items()])}
+
+commands = {
+    'convert': Convert,
+    'validate': Validate,
+    'reencode': Reencode,
+    'diff': Diff,
+}
+
+# Runs in the worker processes, never raises
+def Work(command, path, opts):
+    try:
+        result = commands[command](path, opts)
+        result.update({'path': path, 'ok': True})
+    except Exception as e:
+        result = {'path': path, 'ok': False, 'error': str(e) or type(e).__name__}
+    return result
+
+def Format(result):
+    if not result['ok']:
+        return '%s: FAILED %s' % (result['path'], result['error'])
+    if 'fields' in result:
+        return '%s: %s' % (result['path'], ', '.join(
+            ['%s (%d cells)' % (n, result['cells'][n]) if n in result['cells'] else n
+             for n in result['fields']]) or 'same')
+    if 'changed' in result:
+        return '%s: wrote %s, %d bytes changed' % (result['path'], result['output'],
+                                                   result['changed'])
+    if 'output' in result:
+        return '%s: wrote %s' % (result['path'], result['output'])
+    return '%s: ok' % result['path']
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch operations on tune files')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes')
+    parser.add_argument('--json', action='store_true', help='print JSON lines')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('convert', help='convert between .json and .tune')
+    p.add_argument('--to', choices=['json', 'tune'], required=True)
+    p.add_argument('--out', help='output directory, defaults to next to the input')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('validate', help='check tunes for corruption')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('reencode', help='decode and encode tunes again')
+    p.add_argument('files', nargs='+')
+    p = sub.add_parser('diff', help='list fields that differ from a base tune')
+    p.add_argument('base')
+    p.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    opts = {'to': getattr(args, 'to', None), 'out': getattr(args, 'out', None),
+            'base': getattr(args, 'base', None)}
+    if opts['out']:
+        os.makedirs(opts['out'], exist_ok=True)
+    failed = 0
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+        futures = [pool.submit(Work, args.command, f, opts) for f in args.files]
+        for fut in concurrent.futures.as_completed(futures):
+            result = fut.result()
+            failed += not result['ok']
+            print(json.dumps(result) if args.json else Format(result), flush=True)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()